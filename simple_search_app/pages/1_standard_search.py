@@ -10,11 +10,13 @@
 import streamlit as st
 import pandas as pd
 import json
+import re
 import time
 from datetime import datetime, timedelta
 from snowflake.snowpark.context import get_active_session
-from snowflake.snowpark.functions import col, lit
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 # ページ設定
 st.set_page_config(
@@ -30,69 +32,161 @@ def get_snowflake_session():
 
 session = get_snowflake_session()
 
+# メタデータ取得用のスレッドプール（再実行毎にスレッドを起動しないよう共有する）
+@st.cache_resource
+def get_metadata_pool():
+    return ThreadPoolExecutor(max_workers=8)
+
 # =========================================================
 # 定数定義: データスキーマ（デフォルト値として保持）
 # =========================================================
-DEFAULT_DATA_SCHEMA = "bank_db.bank_schema"
-APP_DATA_SCHEMA = "application_db.application_schema"
+# （SHOWの結果と同じく、未クォート識別子が解決される大文字表記で保持する）
+DEFAULT_DATA_SCHEMA = "BANK_DB.BANK_SCHEMA"
+APP_DATA_SCHEMA = "APPLICATION_DB.APPLICATION_SCHEMA"
 # 検索対象から除外するシステムテーブル
 SYSTEM_TABLES = {"STANDARD_SEARCH_OBJECTS", "ADHOC_SEARCH_OBJECTS", "ANNOUNCEMENTS"}
 # 検索対象から除外するテーブル名のプレフィックス
 EXCLUDED_PREFIXES = ("SNOWPARK_TEMP_TABLE_",)
+# 上記の除外条件をSHOW結果（RESULT_SCAN）に対するSQL述語にしたもの
+_EXCLUDED_TABLES_PREDICATE = (
+    "\"name\" NOT IN (" + ", ".join(f"'{t}'" for t in sorted(SYSTEM_TABLES)) + ")"
+    + "".join(f" AND NOT STARTSWITH(UPPER(\"name\"), '{p}')" for p in EXCLUDED_PREFIXES)
+)
+# クォート不要な識別子（大文字英数字とアンダースコアのみ）
+# 小文字を含む名前はSHOWで大文字小文字を区別するオブジェクト（例: "myDb"）として返るため、クォートが必要
+_PLAIN_IDENTIFIER_RE = re.compile(r"^[A-Z_][A-Z0-9_$]*$")
+# LIMIT句の有無の判定用（末尾のLIMIT句のみを対象にし、"LIMIT"カラムや'no limit'等のリテラルには反応しない）
+_LIMIT_RE = re.compile(r"\bLIMIT\s+\d+(?:\s+OFFSET\s+\d+)?\s*;?\s*$", re.IGNORECASE)
+# クエリ正規化用: 引用符で囲まれたリテラル・識別子以外の連続空白にマッチ
+# （文字列リテラル内はバックスラッシュによるエスケープ（\'など）も考慮する）
+_WHITESPACE_OUTSIDE_QUOTES_RE = re.compile(r"('(?:[^'\\]|\\.|'')*'|\"(?:[^\"]|\"\")*\")|\s+", re.DOTALL)
 
 # =========================================================
 # DB/スキーマ動的選択のヘルパー関数
 # =========================================================
-@st.cache_data(ttl=60, show_spinner=False)
+def _sql_name(name: str) -> str:
+    """DB/スキーマ名をSQLに埋め込める形にする（通常の名前はそのまま、それ以外はクォート）"""
+    if _PLAIN_IDENTIFIER_RE.match(name):
+        return name
+    return '"' + name.replace('"', '""') + '"'
+
+def _sql_qualified_schema(qualified_schema: str) -> str:
+    """DB.SCHEMA形式の各部分を_sql_nameで変換する"""
+    database, _, schema = qualified_schema.partition('.')
+    return f"{_sql_name(database)}.{_sql_name(schema)}" if schema else _sql_name(database)
+
+# カタログはセッション中にほとんど変わらないため長めにキャッシュし、サイドバーのボタンで明示的に更新する
+METADATA_CACHE_TTL = 3600
+
+@st.cache_data(ttl=METADATA_CACHE_TTL, show_spinner=False)
 def get_available_databases():
     """アクセス可能なデータベース一覧を取得"""
     try:
-        result = session.sql("SHOW DATABASES").collect()
-        excluded_dbs = {'SNOWFLAKE', 'SNOWFLAKE_SAMPLE_DATA'}
-        return sorted([row['name'] for row in result if row['name'] not in excluded_dbs])
+        # 除外と並べ替えはRESULT_SCAN側で行い、名前のみを受け取る
+        job = session.sql("SHOW DATABASES").collect_nowait()
+        job.result()
+        result = session.sql(f"""
+        SELECT "name" FROM TABLE(RESULT_SCAN('{job.query_id}'))
+        WHERE "name" NOT IN ('SNOWFLAKE', 'SNOWFLAKE_SAMPLE_DATA')
+        ORDER BY "name"
+        """).collect()
+        return [row['name'] for row in result]
     except Exception as e:
         st.error(f"データベース取得エラー: {str(e)}")
         return []
 
-@st.cache_data(ttl=60, show_spinner=False)
+@st.cache_data(ttl=METADATA_CACHE_TTL, show_spinner=False)
 def get_available_schemas(database_name: str):
     """指定DBのスキーマ一覧を取得"""
     if not database_name:
         return []
     try:
-        result = session.sql(f"SHOW SCHEMAS IN DATABASE {database_name}").collect()
-        excluded_schemas = {'INFORMATION_SCHEMA'}
-        return sorted([row['name'] for row in result if row['name'] not in excluded_schemas])
+        job = session.sql(f"SHOW SCHEMAS IN DATABASE {_sql_name(database_name)}").collect_nowait()
+        job.result()
+        result = session.sql(f"""
+        SELECT "name" FROM TABLE(RESULT_SCAN('{job.query_id}'))
+        WHERE "name" <> 'INFORMATION_SCHEMA'
+        ORDER BY "name"
+        """).collect()
+        return [row['name'] for row in result]
     except Exception as e:
         st.error(f"スキーマ取得エラー: {str(e)}")
         return []
 
-@st.cache_data(ttl=60, show_spinner=False)
+@st.cache_data(ttl=METADATA_CACHE_TTL, show_spinner=False)
+def _list_all_objects(database: str) -> dict:
+    """指定DB内の全テーブル/ビューを一括取得（キー: (スキーマ名, オブジェクト名)、値: 'TABLE' / 'VIEW'）"""
+    objects = {}
+    if not database:
+        return objects
+    # スキーマ毎にSHOWを発行せず、DB単位で1回ずつ取得する
+    # テーブルとビューのSHOWは互いに独立しているため並列に発行する
+    # 失敗時は例外をそのまま送出する（空の一覧を長時間キャッシュしないため。表示は呼び出し側で行う）
+    def _show(kind: str):
+        job = session.sql(f"SHOW {kind}S IN DATABASE {_sql_name(database)}").collect_nowait()
+        job.result()
+        # 除外対象の絞り込みと並べ替えはRESULT_SCAN側で行い、必要な2カラムのみ受け取る
+        # （並列実行のためLAST_QUERY_ID()ではなくSHOWのクエリIDを直接指定する）
+        where = f"WHERE {_EXCLUDED_TABLES_PREDICATE}" if kind == 'TABLE' else ""
+        return session.sql(f"""
+        SELECT "schema_name", "name" FROM TABLE(RESULT_SCAN('{job.query_id}'))
+        {where}
+        ORDER BY "schema_name", "name"
+        """).collect()
+    pool = get_metadata_pool()
+    fut_t = pool.submit(_show, 'TABLE')
+    fut_v = pool.submit(_show, 'VIEW')
+    tables, views = fut_t.result(), fut_v.result()
+    for row in tables:
+        objects[(row['schema_name'], row['name'])] = 'TABLE'
+    for row in views:
+        objects[(row['schema_name'], row['name'])] = 'VIEW'
+    return objects
+
+def _object_exists(qualified_schema: str, table_name: str) -> bool:
+    """DB.SCHEMA形式のスキーマにオブジェクトが存在するかをカタログキャッシュで判定"""
+    database, _, schema = qualified_schema.partition('.')
+    try:
+        objects = _list_all_objects(database)
+    except Exception:
+        # 一覧取得のエラーはテーブル選択・サイドバー側で表示済みのため、ここでは存在しない扱いにする
+        return False
+    # 未クォートの識別子は大文字で格納されるため、大文字でも確認する
+    return (schema, table_name) in objects or (schema.upper(), table_name) in objects
+
+@st.cache_data(ttl=METADATA_CACHE_TTL, show_spinner=False)
 def get_available_tables_dynamic(database: str, schema: str):
     """指定スキーマのテーブル一覧を取得"""
     if not database or not schema:
         return []
-    try:
-        result = session.sql(f"SHOW TABLES IN {database}.{schema}").collect()
-        tables = []
-        for row in result:
-            name = row['name']
-            if name not in SYSTEM_TABLES and not name.upper().startswith(EXCLUDED_PREFIXES):
-                tables.append(name)
-        return sorted(tables)
-    except:
-        return []
+    objects = _list_all_objects(database)
+    # 除外対象の絞り込みと並べ替えは取得時にSQL側で済んでいる
+    return [
+        name for (schema_name, name), kind in objects.items()
+        if schema_name == schema and kind == 'TABLE'
+    ]
 
-@st.cache_data(ttl=60, show_spinner=False)
+@st.cache_data(ttl=METADATA_CACHE_TTL, show_spinner=False)
 def get_available_views_dynamic(database: str, schema: str):
     """指定スキーマのビュー一覧を取得"""
     if not database or not schema:
         return []
-    try:
-        result = session.sql(f"SHOW VIEWS IN {database}.{schema}").collect()
-        return sorted([row['name'] for row in result])
-    except:
-        return []
+    objects = _list_all_objects(database)
+    return [
+        name for (schema_name, name), kind in objects.items()
+        if schema_name == schema and kind == 'VIEW'
+    ]
+
+@st.cache_data(ttl=METADATA_CACHE_TTL, show_spinner=False)
+def get_table_view_counts(database: str, schema: str) -> dict:
+    """指定スキーマのテーブル数・ビュー数を1回の走査で集計（{'TABLE': n, 'VIEW': m}）"""
+    counts = {'TABLE': 0, 'VIEW': 0}
+    if not database or not schema:
+        return counts
+    for (schema_name, _), kind in _list_all_objects(database).items():
+        if schema_name == schema:
+            counts[kind] += 1
+    return counts
 
 def get_current_data_schema():
     """現在選択されているデータスキーマを取得（DB.SCHEMA形式）"""
@@ -103,52 +197,69 @@ def get_current_data_schema():
 # =========================================================
 # セッション状態の初期化
 # =========================================================
-if 'new_selected_columns_state' not in st.session_state:
-    st.session_state.new_selected_columns_state = set()
-if 'last_result_df' not in st.session_state:
-    st.session_state.last_result_df = None
-if 'where_conditions_list' not in st.session_state:
-    st.session_state.where_conditions_list = []
-if 'order_by_conditions_list' not in st.session_state:
-    st.session_state.order_by_conditions_list = []
-if 'favorites' not in st.session_state:
-    st.session_state.favorites = []
-if 'execute_query_request' not in st.session_state:
-    st.session_state.execute_query_request = None
-if 'date_condition' not in st.session_state:
-    st.session_state.date_condition = {}
-
-# DB/スキーマ選択のセッション状態
-if 'selected_database' not in st.session_state:
-    st.session_state.selected_database = ""
-if 'selected_schema' not in st.session_state:
-    st.session_state.selected_schema = ""
+# 未設定のキーのみ初期値を入れる（リスト/セット等はこのdictごと毎回新しく作られるため共有されない）
+for key, default in {
+    'new_selected_columns_state': set(),
+    'last_result_df': None,
+    'last_result_csv': None,
+    'where_conditions_list': [],
+    'order_by_conditions_list': [],
+    'favorites': [],
+    'execute_query_request': None,
+    'date_condition': {},
+    # DB/スキーマ選択のセッション状態
+    'selected_database': "",
+    'selected_schema': "",
+}.items():
+    st.session_state.setdefault(key, default)
 
 # =========================================================
 # ユーティリティ関数
 # =========================================================
 # テーブル作成関数は削除 - setup SQLで事前作成済み
 
-def load_standard_search_objects():
-    try:
-        result = session.sql("SELECT * FROM application_db.application_schema.STANDARD_SEARCH_OBJECTS ORDER BY created_at DESC").collect()
-        return [row.as_dict() for row in result]
-    except:
-        return []
+# 一覧表示で使用するカラム（SELECT * を避けて必要なカラムのみ取得）
+STANDARD_SEARCH_LIST_COLUMNS = "object_id, object_name, description, search_query, created_at, is_favorite, execution_count, last_executed"
 
-def save_standard_search_object(object_data: dict):
-    """定型検索オブジェクトを保存"""
+@st.cache_data(ttl=120, show_spinner=False)
+def load_standard_search_objects():
+    """定型検索オブジェクト一覧を取得（保存・お気に入り・実行回数の更新時はclear()で破棄する）"""
+    # 失敗時は例外をそのまま送出する（一時的なエラーを「保存済みなし」としてキャッシュしないため。表示は呼び出し側で行う）
+    df = session.sql(f"SELECT {STANDARD_SEARCH_LIST_COLUMNS} FROM application_db.application_schema.STANDARD_SEARCH_OBJECTS ORDER BY created_at DESC").to_pandas()
+    # 行毎のRow→dict変換を避けてまとめて変換する（NULLはNaN/NaTではなくNoneに揃える）
+    objects = df.astype(object).where(df.notna(), None).to_dict(orient='records')
+    # SQLプレビューで毎回判定しないよう、LIMIT句の有無を取得時に求めておく
+    for obj in objects:
+        obj['HAS_LIMIT'] = bool(obj['SEARCH_QUERY'] and _LIMIT_RE.search(obj['SEARCH_QUERY']))
+    return objects
+
+# 保存時に値を指定するカラム（それ以外はテーブルのDEFAULT値を使用）
+STANDARD_SEARCH_SAVE_COLUMNS = ['object_id', 'object_name', 'description', 'search_query']
+
+def save_standard_search_object(object_data):
+    """定型検索オブジェクトを保存（dict 1件、またはdictのリストで複数件）"""
+    records = [object_data] if isinstance(object_data, dict) else list(object_data)
+    if not records:
+        return True
     try:
-        session.sql("""
-        INSERT INTO application_db.application_schema.STANDARD_SEARCH_OBJECTS (
-            object_id, object_name, description, search_query
-        ) VALUES (?, ?, ?, ?)
-        """, params=[
-            object_data['object_id'],
-            object_data['object_name'],
-            object_data['description'],
-            object_data['search_query']
-        ]).collect()
+        if len(records) == 1:
+            # 1件の場合はステージを経由しないINSERTの方が往復が少ない
+            record = records[0]
+            session.sql("""
+            INSERT INTO application_db.application_schema.STANDARD_SEARCH_OBJECTS (
+                object_id, object_name, description, search_query
+            ) VALUES (?, ?, ?, ?)
+            """, params=[record[c] for c in STANDARD_SEARCH_SAVE_COLUMNS]).collect()
+        else:
+            # 複数件はwrite_pandas（PUT + COPY INTO）で一括ロードする
+            pdf = pd.DataFrame(records, columns=STANDARD_SEARCH_SAVE_COLUMNS)
+            pdf.columns = [c.upper() for c in pdf.columns]
+            session.write_pandas(
+                pdf, "STANDARD_SEARCH_OBJECTS",
+                database="APPLICATION_DB", schema="APPLICATION_SCHEMA",
+                auto_create_table=False, overwrite=False
+            )
+        load_standard_search_objects.clear()
         return True
     except Exception as e:
         st.error(f"保存エラー: {str(e)}")
@@ -156,31 +267,32 @@ def save_standard_search_object(object_data: dict):
 
 def execute_standard_search(object_id: str):
     try:
-        result = session.sql("SELECT * FROM application_db.application_schema.STANDARD_SEARCH_OBJECTS WHERE object_id = ?", params=[object_id]).collect()
+        result = session.sql("SELECT search_query FROM application_db.application_schema.STANDARD_SEARCH_OBJECTS WHERE object_id = ?", params=[object_id]).collect()
         if not result:
             return False, "検索オブジェクトが見つかりません"
-        search_obj = result[0].as_dict()
-        search_query = search_obj['SEARCH_QUERY']
+        search_query = result[0]['SEARCH_QUERY']
         search_result = session.sql(search_query).collect()
+        # 実行回数の更新は結果表示を待たせないよう非同期で投入する
         session.sql("""
         UPDATE application_db.application_schema.STANDARD_SEARCH_OBJECTS 
         SET execution_count = execution_count + 1, 
             last_executed = CURRENT_TIMESTAMP()
         WHERE object_id = ?
-        """, params=[object_id]).collect()
+        """, params=[object_id]).collect_nowait()
         return True, search_result
     except Exception as e:
         return False, str(e)
 
 def update_execution_count(object_id: str):
-    """実行回数を更新する専用関数"""
+    """実行回数を更新する（結果表示を待たせないよう、UPDATEは完了を待たずに非同期で投入する）"""
     try:
         session.sql("""
         UPDATE application_db.application_schema.STANDARD_SEARCH_OBJECTS 
         SET execution_count = execution_count + 1, 
             last_executed = CURRENT_TIMESTAMP()
         WHERE object_id = ?
-        """, params=[object_id]).collect()
+        """, params=[object_id]).collect_nowait()
+        load_standard_search_objects.clear()
         return True
     except Exception as e:
         st.error(f"実行回数更新エラー: {str(e)}")
@@ -194,6 +306,7 @@ def add_to_favorites(object_id: str):
         SET is_favorite = TRUE 
         WHERE object_id = ?
         """, params=[object_id]).collect()
+        load_standard_search_objects.clear()
         return True
     except:
         return False
@@ -201,81 +314,109 @@ def add_to_favorites(object_id: str):
 # =========================================================
 # ユーティリティ関数（キャッシュ対応）
 # =========================================================
-@st.cache_data(ttl=300, show_spinner=False)
 def get_table_schema(table_name: str) -> str:
     """テーブルがどのスキーマに存在するかを判定して返す"""
+    # 選択中のDB/スキーマに依存し、判定自体はカタログキャッシュの参照のみのため、この関数ではキャッシュしない
+    # （テーブル名だけをキーに全セッション共通でキャッシュすると、別スキーマの同名テーブルで古いスキーマが返る）
     # まず選択中のスキーマを確認
     current_schema = get_current_data_schema()
-    try:
-        quoted_table = f'"{table_name}"' if not table_name.startswith('"') else table_name
-        session.sql(f"DESCRIBE TABLE {current_schema}.{quoted_table}").collect()
+    # DESCRIBEの失敗（例外）で判定せず、カタログキャッシュの参照のみで判定する
+    if _object_exists(current_schema, table_name):
         return current_schema
-    except:
-        pass
     # 次にapplication_db.application_schemaを確認（システムテーブル用）
-    try:
-        quoted_table = f'"{table_name}"' if not table_name.startswith('"') else table_name
-        session.sql(f"DESCRIBE TABLE {APP_DATA_SCHEMA}.{quoted_table}").collect()
+    # システムテーブルはカタログ取得時に除外しているため、カタログではなく名前で判定する
+    if table_name in SYSTEM_TABLES or _object_exists(APP_DATA_SCHEMA, table_name):
         return APP_DATA_SCHEMA
-    except:
-        pass
     return current_schema  # デフォルトは選択中のスキーマ
 
-def is_excluded_table(table_name: str) -> bool:
-    """除外対象のテーブルかどうかを判定"""
-    if table_name in SYSTEM_TABLES:
-        return True
-    if table_name.upper().startswith(EXCLUDED_PREFIXES):
-        return True
-    return False
-
 def get_available_relations():
     """選択されたスキーマからテーブルとビュー名を取得"""
-    tables = []
-    views = []
-    
     # 選択されたDB/スキーマからテーブル/ビューを取得
     selected_db = st.session_state.get('selected_database', '')
     selected_schema = st.session_state.get('selected_schema', '')
     
     if selected_db and selected_schema:
-        # テーブル取得
-        tables = get_available_tables_dynamic(selected_db, selected_schema)
-        # ビュー取得
-        views = get_available_views_dynamic(selected_db, selected_schema)
-    else:
-        st.warning("⚠️ サイドバーでデータベースとスキーマを選択してください")
-    
+        try:
+            return _get_relation_labels(selected_db, selected_schema)
+        except Exception as e:
+            st.error(f"テーブル/ビュー一覧取得エラー: {str(e)}")
+            return []
+    st.warning("⚠️ サイドバーでデータベースとスキーマを選択してください")
+    return []
+
+@st.cache_data(ttl=METADATA_CACHE_TTL, show_spinner=False)
+def _get_relation_labels(database: str, schema: str):
+    """テーブル/ビュー名にラベルを付けて並べた一覧（DB/スキーマ単位でキャッシュ）"""
+    tables = get_available_tables_dynamic(database, schema)
+    views = get_available_views_dynamic(database, schema)
     # ラベル付けして返す
     labeled = [f"[TABLE] {t}" for t in tables] + [f"[VIEW] {v}" for v in views]
     return sorted(labeled)
 
+def _describe_style_type(data_type_json: str) -> str:
+    """SHOW COLUMNSのdata_type（JSON）をDESCRIBE TABLEと同じ形式の型名に変換"""
+    try:
+        info = json.loads(data_type_json)
+    except:
+        return data_type_json or ""
+    kind = info.get('type', '')
+    if kind == 'FIXED':
+        return f"NUMBER({info.get('precision', 38)},{info.get('scale', 0)})"
+    if kind == 'TEXT':
+        return f"VARCHAR({info.get('length', 16777216)})"
+    if kind == 'REAL':
+        return "FLOAT"
+    if kind == 'BINARY':
+        return f"BINARY({info.get('length', 8388608)})"
+    if kind in ('TIME', 'TIMESTAMP_NTZ', 'TIMESTAMP_LTZ', 'TIMESTAMP_TZ'):
+        return f"{kind}({info.get('scale', 9)})"
+    return kind
+
 @st.cache_data(ttl=300, show_spinner=False)
-def get_table_columns_with_types_cached(table_name: str):
-    """テーブル/ビューのカラム名とデータ型を取得（5分キャッシュ）"""
+def _list_all_columns(qualified_schema: str) -> dict:
+    """スキーマ内の全テーブル/ビューのカラム名とデータ型を一括取得（キー: テーブル名）"""
+    columns = {}
+    # テーブル毎のDESCRIBEではなく、SHOW COLUMNSを1回だけ発行する
+    # （失敗時は例外をそのまま送出し、空の結果をキャッシュしない。呼び出し側でDESCRIBEにフォールバックする）
+    for row in session.sql(f"SHOW COLUMNS IN SCHEMA {_sql_qualified_schema(qualified_schema)}").collect():
+        columns.setdefault(row['table_name'], []).append(
+            {'name': row['column_name'], 'type': _describe_style_type(row['data_type'])}
+        )
+    return columns
+
+@st.cache_data(ttl=300, max_entries=128, show_spinner=False)
+def _get_columns_with_types(schema: str, table_name: str):
+    """指定スキーマのテーブル/ビューのカラム名とデータ型を取得"""
+    try:
+        cached_columns = _list_all_columns(schema).get(table_name)
+    except Exception as e:
+        st.warning(f"スキーマ単位のカラム取得に失敗したため、テーブル単位で取得します: {str(e)}")
+        cached_columns = None
+    if cached_columns:
+        return cached_columns
     try:
+        # スキーマ単位の取得で見つからない場合のみDESCRIBEで取得する
         # 日本語テーブル名に対応するためダブルクォーテーションで囲む
-        quoted_table_name = f'"{table_name}"' if not table_name.startswith('"') else table_name
-        # テーブルのスキーマを動的に判定
-        schema = get_table_schema(table_name)
-        result = session.sql(f"DESCRIBE TABLE {schema}.{quoted_table_name}").collect()
+        result = session.sql(f"DESCRIBE TABLE {_sql_qualified_schema(schema)}.{quote_identifier(table_name)}").collect()
         return [{'name': row['name'], 'type': row['type']} for row in result]
     except Exception as e:
         st.error(f"テーブル情報取得エラー ({table_name}): {str(e)}")
         return []
 
 
+@lru_cache(maxsize=1024)
 def parse_relation_label(label: str) -> str:
     """[TABLE]/[VIEW] ラベルからオブジェクト名のみ取り出す"""
     return label.split(' ', 1)[1] if ' ' in label else label
 
+@lru_cache(maxsize=4096)
 def quote_identifier(identifier: str) -> str:
-    """SQL識別子（テーブル名、カラム名）を適切にクォートする"""
+    """SQL識別子（テーブル名、カラム名）を適切にクォートする（同じ識別子は何度も渡されるため結果をキャッシュ）"""
     if not identifier:
         return identifier
     
-    # 前後の空白、改行、特殊文字をトリム
-    identifier = identifier.strip().strip('\n\r\t')
+    # 前後の空白、改行、タブをトリム（strip()は改行・タブも対象に含む）
+    identifier = identifier.strip()
     
     # 既にクォートされている場合はそのまま返す
     if identifier.startswith('"') and identifier.endswith('"'):
@@ -287,18 +428,24 @@ def quote_identifier(identifier: str) -> str:
     escaped_identifier = identifier.replace('"', '""')
     return f'"{escaped_identifier}"'
 
+DATE_TYPES = [
+    'DATE', 'DATETIME', 'TIMESTAMP', 'TIMESTAMP_NTZ', 'TIMESTAMP_LTZ', 'TIMESTAMP_TZ',
+    'TIME', 'DATETIME_NTZ', 'DATETIME_LTZ', 'DATETIME_TZ'
+]
+DATE_KEYWORDS = [
+    'DATE', 'DT', '日付', '年月日', 'YMD', 'YYYYMMDD',
+    '_AT', 'CREATED', 'UPDATED', 'REGISTERED', 'TIMESTAMP',
+    '登録日', '更新日', '作成日', '開始日', '終了日', '取引日', '発生日'
+]
+# 部分一致判定をキーワード毎のループではなく1回の正規表現検索で行う
+_DATE_TYPE_RE = re.compile('|'.join(map(re.escape, DATE_TYPES)))
+_DATE_KEYWORD_RE = re.compile('|'.join(map(re.escape, DATE_KEYWORDS)))
+
 def is_date_type(data_type: str) -> bool:
     """データ型が日付型かどうかを判定する"""
     if not data_type:
         return False
-    
-    data_type_upper = data_type.upper()
-    date_types = [
-        'DATE', 'DATETIME', 'TIMESTAMP', 'TIMESTAMP_NTZ', 'TIMESTAMP_LTZ', 'TIMESTAMP_TZ',
-        'TIME', 'DATETIME_NTZ', 'DATETIME_LTZ', 'DATETIME_TZ'
-    ]
-    
-    return any(date_type in data_type_upper for date_type in date_types)
+    return bool(_DATE_TYPE_RE.search(data_type.upper()))
 
 def is_date_like_column(col_name: str, data_type: str) -> bool:
     """カラムが日付データを含む可能性があるかを判定する（型とカラム名の両方をチェック）"""
@@ -307,76 +454,118 @@ def is_date_like_column(col_name: str, data_type: str) -> bool:
         return True
     
     # カラム名に日付を示すキーワードが含まれている場合（VARCHAR型でも日付として扱う）
-    col_name_upper = col_name.upper()
-    date_keywords = [
-        'DATE', 'DT', '日付', '年月日', 'YMD', 'YYYYMMDD',
-        '_AT', 'CREATED', 'UPDATED', 'REGISTERED', 'TIMESTAMP',
-        '登録日', '更新日', '作成日', '開始日', '終了日', '取引日', '発生日'
-    ]
-    
-    return any(keyword in col_name_upper for keyword in date_keywords)
+    return bool(_DATE_KEYWORD_RE.search(col_name.upper()))
 
-def get_column_data_type(table_cols: list, column_name: str) -> str:
-    """指定されたカラムのデータ型を取得する"""
-    for col in table_cols:
-        if col['name'] == column_name:
-            return col['type']
-    return ""
+@st.cache_data(ttl=300, max_entries=128, show_spinner=False)
+def _partition_date_columns(schema: str, table_name: str):
+    """カラム一覧を1回の走査で日付系とそれ以外に分類（テーブル単位でキャッシュ）"""
+    date_cols, non_date_cols = [], []
+    for c in _get_columns_with_types(schema, table_name):
+        (date_cols if is_date_like_column(c['name'], c['type']) else non_date_cols).append(c)
+    return date_cols, non_date_cols
 
 
 # =========================================================
 # 実行ロジック
 # =========================================================
+def quote_literal(value) -> str:
+    """値をSQLの文字列リテラルにする（バックスラッシュとシングルクォートをエスケープ）"""
+    # Snowflakeの文字列リテラルではバックスラッシュもエスケープ文字のため、先に二重化してから ' を '' にする
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "''") + "'"
+
+def format_timestamps(values: list) -> list:
+    """日時（datetime/ISO形式文字列）のリストをまとめて 'YYYY-MM-DD HH:MM' 形式に整形（解釈できない値・NULLはNone）"""
+    if not values:
+        return []
+    parsed = pd.to_datetime(pd.Series(values, dtype=object), utc=True, errors='coerce')
+    formatted = parsed.dt.strftime('%Y-%m-%d %H:%M')
+    return [None if pd.isna(v) else v for v in formatted]
+
+def build_standard_search_query(table_schema: str, table_name: str, date_condition: dict,
+                                where_conditions: list, order_by_conditions: list, selected_columns: list) -> str:
+    """画面の入力内容から定型検索のSQLを生成する"""
+    # WHERE句の生成
+    where_clauses = []
+    
+    # 日付条件を最初に追加（必須）
+    if date_condition:
+        quoted_date_col = quote_identifier(date_condition['column'])
+        date_clause = f"{quoted_date_col} BETWEEN {quote_literal(date_condition['start_date'])} AND {quote_literal(date_condition['end_date'])}"
+        where_clauses.append(date_clause)
+    
+    # その他の条件を追加
+    for cond in where_conditions:
+        quoted_col = quote_identifier(cond['column'])
+        cond_str = f"{quoted_col} {cond['operator']}"
+        # 入力値はエスケープしてリテラル化する（保存後にそのまま再実行されるため、バインド変数は使わない）
+        if cond['operator'].upper() == 'LIKE':
+            cond_str += f" {quote_literal('%' + cond['value'] + '%')}"
+        else:
+            cond_str += f" {quote_literal(cond['value'])}"
+        
+        # 最初の条件以外は論理演算子を追加
+        if where_clauses:  # 日付条件がある場合はANDを追加
+            where_clauses.append(f"AND {cond_str}")
+        else:
+            where_clauses.append(cond_str)
+    
+    where_clause = " WHERE " + " ".join(where_clauses) if where_clauses else ""
+    
+    # ORDER BY句の生成
+    order_by_clauses = [f"{quote_identifier(cond['column'])} {cond['direction']}" for cond in order_by_conditions]
+    order_by_clause = " ORDER BY " + ", ".join(order_by_clauses) if order_by_clauses else ""
+    
+    # SELECT句でカラム名をクォート
+    select_clause = ", ".join(quote_identifier(col) for col in selected_columns) if selected_columns else "*"
+    
+    # テーブル名もクォート（スキーマを含む完全修飾名を使用）
+    return f"SELECT {select_clause} FROM {table_schema}.{quote_identifier(table_name)}{where_clause}{order_by_clause}"
+
+def fetch_dataframe(query: str) -> pd.DataFrame:
+    """クエリ結果をArrowのバッチ単位で取得してDataFrameに変換する（pyarrowがない場合はto_pandasで取得）"""
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return session.sql(query).to_pandas()
+
+    cur = session.connection.cursor()
+    try:
+        cur.execute(query)
+        # 結果全体を1つのArrowテーブルにせず、バッチ単位でDataFrame化してメモリのピークを抑える
+        frames = [
+            batch.to_pandas(split_blocks=True, self_destruct=True)
+            for batch in cur.fetch_arrow_batches()
+        ]
+        if not frames:
+            # 0件の場合はバッチが返らないため、カラム名のみの空DataFrameを返す
+            return pd.DataFrame(columns=[c[0] for c in cur.description])
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=True)
+    finally:
+        cur.close()
+
 def execute_query(search_query: str, all_rows: bool, limit_rows: int, show_sql: bool):
     """
     クエリを実行し、結果をセッション状態に保存する
     """
     def _sanitize_query(q: str) -> str:
         return q.strip().rstrip(';')
-    
-    def _fix_japanese_identifiers(query: str) -> str:
-        """日本語のテーブル名・カラム名を自動的にクォートする（改良版）"""
-        import re
-        
-        # 既にquote_identifierで生成されたクエリかチェック
-        if '""' in query:
-            # 二重クォートを修正
-            query = query.replace('""', '"')
-        
-        # 日本語文字を含む識別子パターン（ただし既にクォートされていないもの）
-        japanese_pattern = r'[あ-んア-ンー一-龯]+'
-        
-        # FROM句のテーブル名をクォート（既にクォートされていない場合のみ）
-        def quote_table_name(match):
-            full_match = match.group(0)
-            table_name = match.group(1)
-            if re.search(japanese_pattern, table_name) and not table_name.startswith('"'):
-                return f'FROM "{table_name}"'
-            return full_match
-        
-        query = re.sub(r'FROM\s+([^\s\'"]+)', quote_table_name, query, flags=re.IGNORECASE)
-        
-        # WHERE句のカラム名をクォート（値の部分は除外）
-        def quote_where_column(match):
-            full_match = match.group(0)
-            col_name = match.group(1)
-            if re.search(japanese_pattern, col_name) and not col_name.startswith('"'):
-                return full_match.replace(col_name, f'"{col_name}"')
-            return full_match
-        
-        # WHERE, AND, OR句での日本語カラム名をクォート（等号の前の部分のみ）
-        query = re.sub(r'(WHERE|AND|OR)\s+([^\s\'"=<>!]+)\s*([=<>!]+)', quote_where_column, query, flags=re.IGNORECASE)
-        
-        return query
 
+    def _normalize_query(q: str) -> str:
+        """結果キャッシュが効くよう、リテラル以外の空白を1つにまとめる（コメントを含む場合はそのまま）"""
+        if '--' in q or '/*' in q:
+            return q
+        return _WHITESPACE_OUTSIDE_QUOTES_RE.sub(lambda m: m.group(1) or ' ', q)
+    
     try:
-        base_query = _sanitize_query(search_query)
+        base_query = _normalize_query(_sanitize_query(search_query))
         
         # 保存時にquote_identifierで既に正しく処理されているため、
         # 実行時の自動修正は行わない（二重処理を避ける）
         final_query = base_query
         
-        if (not all_rows) and " LIMIT " not in base_query.upper():
+        if (not all_rows) and not _LIMIT_RE.search(base_query):
             final_query = f"{base_query} LIMIT {int(limit_rows)}"
         
         # SQL表示（show_sqlがTrueの場合）
@@ -393,33 +582,26 @@ def execute_query(search_query: str, all_rows: bool, limit_rows: int, show_sql:
                     st.code(final_query, language="sql")
 
         with st.spinner("検索実行中..."):
-            # まず件数チェック
+            # データ取得実行（件数は取得結果から判定し、COUNT(*)による二重実行は行わない）
             try:
-                test_query = f"SELECT COUNT(*) FROM ({final_query})"
-                row_count = session.sql(test_query).collect()[0][0]
-                
-                if row_count > 5000:
-                    st.warning(f"検索結果が5,000行を超えています。表示に時間がかかる場合があります。取得件数: {row_count} 行")
-                elif row_count == 0:
-                    st.warning("検索条件に該当するデータがありません。")
-                    
-            except Exception as count_error:
-                st.error(f"件数チェックエラー: {str(count_error)}")
-                st.write("件数チェック用SQL:")
-                st.code(test_query, language="sql")
-                return
-
-            # データ取得実行
-            try:
-                df_result = session.sql(final_query).to_pandas()
-                st.session_state.last_result_df = df_result
-                st.success(f"✅ 取得件数: {len(df_result)} 行。下部の『📄 出力結果』に表示しました。")
+                df_result = fetch_dataframe(final_query)
             except Exception as data_error:
                 st.error(f"データ取得エラー: {str(data_error)}")
                 st.write("データ取得用SQL:")
                 st.code(final_query, language="sql")
                 return
 
+            row_count = len(df_result)
+            if row_count > 5000:
+                st.warning(f"検索結果が5,000行を超えています。表示に時間がかかる場合があります。取得件数: {row_count} 行")
+            elif row_count == 0:
+                st.warning("検索条件に該当するデータがありません。")
+
+            st.session_state.last_result_df = df_result
+            # CSVは結果が変わった時だけ作り直す
+            st.session_state.last_result_csv = None
+            st.success(f"✅ 取得件数: {row_count} 行。下部の『📄 出力結果』に表示しました。")
+
     except Exception as e:
         st.error(f"検索エラー: {str(e)}")
         st.write("実行クエリの参考:")
@@ -479,9 +661,27 @@ else:
 
 # 選択中の情報を表示
 if st.session_state.selected_database and st.session_state.selected_schema:
-    tables = get_available_tables_dynamic(st.session_state.selected_database, st.session_state.selected_schema)
-    views = get_available_views_dynamic(st.session_state.selected_database, st.session_state.selected_schema)
-    st.sidebar.info(f"📊 テーブル: {len(tables)}個 / ビュー: {len(views)}個")
+    try:
+        counts = get_table_view_counts(st.session_state.selected_database, st.session_state.selected_schema)
+        st.sidebar.info(f"📊 テーブル: {counts['TABLE']}個 / ビュー: {counts['VIEW']}個")
+    except Exception as e:
+        st.sidebar.error(f"テーブル/ビュー一覧取得エラー: {str(e)}")
+
+if st.sidebar.button("🔄 メタデータ更新", key="std_search_refresh_metadata"):
+    for cached_func in (
+        get_available_databases,
+        get_available_schemas,
+        _list_all_objects,
+        get_available_tables_dynamic,
+        get_available_views_dynamic,
+        get_table_view_counts,
+        _get_relation_labels,
+        _list_all_columns,
+        _get_columns_with_types,
+        _partition_date_columns,
+    ):
+        cached_func.clear()
+    st.rerun()
 
 st.sidebar.markdown("---")
 
@@ -489,6 +689,51 @@ st.sidebar.markdown("---")
 st.title("🔍 定型検索")
 st.header("事前定義された検索テンプレートの管理と実行")
 
+@st.fragment
+def column_picker_fragment(table_cols: list):
+    """出力項目（SELECT句）のカラム選択。カラム検索の入力ではこのフラグメントのみ再実行する"""
+    type_map = {c['name']: c['type'] for c in table_cols}
+    filtered_names = list(type_map)
+    
+    filter_text = st.text_input("カラム検索（部分一致）", key="col_filter_main")
+    if filter_text:
+        filtered_names = [n for n in filtered_names if filter_text.lower() in n.lower()]
+    
+    # multiselectの値（キー: col_multiselect）を選択状態の正とする
+    if 'col_multiselect' not in st.session_state:
+        st.session_state.col_multiselect = sorted(st.session_state.new_selected_columns_state)
+    
+    c1, c2 = st.columns(2)
+    with c1:
+        if st.button("✅ 全選択", key="btn_select_all_cols_main"):
+            st.session_state.col_multiselect = filtered_names
+            st.session_state.new_selected_columns_state = set(filtered_names)
+            st.rerun()
+    with c2:
+        if st.button("🧹 全解除", key="btn_clear_cols_main"):
+            st.session_state.col_multiselect = []
+            st.session_state.new_selected_columns_state = set()
+            st.rerun()
+
+    # 別テーブルのカラムは選択から外し、選択済みのカラムは検索で絞り込んでも選択肢に残す
+    current = [n for n in st.session_state.col_multiselect if n in type_map]
+    st.session_state.col_multiselect = current
+    filtered_set = set(filtered_names)
+    options = filtered_names + [n for n in current if n not in filtered_set]
+
+    selected_names = st.multiselect(
+        "表示カラム",
+        options=options,
+        format_func=lambda n: f"{n} ({type_map[n]})",
+        key="col_multiselect",
+        help="表示するカラムを選択（未選択の場合は全カラム）"
+    )
+    # 選択が変わった場合はページ全体を再実行し、フラグメント外のSQLプレビューにも反映する
+    # （カラム検索の入力ではこのフラグメントのみ再実行する）
+    if set(selected_names) != st.session_state.new_selected_columns_state:
+        st.session_state.new_selected_columns_state = set(selected_names)
+        st.rerun()
+
 # ---
 # 新規作成（メイン画面ワイドUI）
 # ---
@@ -503,30 +748,28 @@ with colL:
     relations = get_available_relations()
     selected_relation_label = st.selectbox("テーブル/ビューを選択", relations, key="new_relation_select")
     selected_table = parse_relation_label(selected_relation_label) if selected_relation_label else ""
+    # スキーマとカラム情報は1回だけ解決し、日付指定・WHERE句・ORDER BY句・SELECT句・SQL生成で共有する
+    table_schema = get_table_schema(selected_table) if selected_table else ""
+    table_cols = _get_columns_with_types(table_schema, selected_table) if selected_table else []
+    date_columns, non_date_columns = _partition_date_columns(table_schema, selected_table) if selected_table else ([], [])
 
       # 日付指定ブロック（独立・必須）
     st.markdown("#### 📅 日付指定（必須）")
     if selected_table:
-        table_cols = get_table_columns_with_types_cached(selected_table)
-        
-        # 日付型カラムを抽出（データ型とカラム名の両方でチェック）
-        date_columns = [col for col in table_cols if is_date_like_column(col['name'], col['type'])]
-        
+        # 日付型カラム（データ型とカラム名の両方でチェック）はテーブル選択時に分類済み
         if date_columns:
             st.info(f"📅 日付型カラムが {len(date_columns)} 件見つかりました")
             
-            # 日付カラム選択
-            date_col_options = [""] + [f"{col['name']} ({col['type']})" for col in date_columns]
-            selected_date_col_label = st.selectbox(
-                "日付カラムを選択",
-                date_col_options,
-                key="date_col_select",
-                help="検索対象の日付カラムを選択してください"
-            )
-            
-            if selected_date_col_label:
-                # カラム名を抽出
-                selected_date_col = selected_date_col_label.split(" (")[0]
+            # 日付カラム・期間の入力はフォームにまとめ、確定ボタン押下時のみ再実行・条件更新する
+            with st.form("date_form", clear_on_submit=False):
+                # 日付カラム選択
+                date_col_options = [""] + [f"{col['name']} ({col['type']})" for col in date_columns]
+                selected_date_col_label = st.selectbox(
+                    "日付カラムを選択",
+                    date_col_options,
+                    key="date_col_select",
+                    help="検索対象の日付カラムを選択してください"
+                )
                 
                 # 日付範囲指定
                 col_date1, col_date2 = st.columns(2)
@@ -542,23 +785,27 @@ with colL:
                         value=datetime.now().date(),
                         key="date_end"
                     )
-                
-                # 日付範囲の検証
-                if start_date and end_date:
-                    if start_date > end_date:
-                        st.error("❌ 開始日は終了日より前の日付を指定してください")
-                    else:
-                        st.success(f"📅 検索期間: {start_date} 〜 {end_date} ({end_date - start_date + timedelta(days=1)}日間)")
-                        
-                        # 日付条件をセッション状態に保存
-                        if 'date_condition' not in st.session_state:
-                            st.session_state.date_condition = {}
-                        
-                        st.session_state.date_condition = {
-                            "column": selected_date_col,
-                            "start_date": start_date.strftime('%Y-%m-%d'),
-                            "end_date": end_date.strftime('%Y-%m-%d')
-                        }
+                date_submitted = st.form_submit_button("日付を確定")
+            
+            # 日付範囲の検証（確定時のみ）
+            if date_submitted:
+                if not selected_date_col_label:
+                    st.error("❌ 日付カラムを選択してください")
+                elif start_date > end_date:
+                    st.error("❌ 開始日は終了日より前の日付を指定してください")
+                else:
+                    # カラム名を抽出して日付条件をセッション状態に保存
+                    st.session_state.date_condition = {
+                        "column": selected_date_col_label.split(" (")[0],
+                        "start_date": start_date.strftime('%Y-%m-%d'),
+                        "end_date": end_date.strftime('%Y-%m-%d')
+                    }
+            
+            # 確定済みの日付条件を表示
+            date_cond = st.session_state.date_condition
+            if date_cond:
+                days = (datetime.strptime(date_cond['end_date'], '%Y-%m-%d') - datetime.strptime(date_cond['start_date'], '%Y-%m-%d')).days + 1
+                st.success(f"📅 検索期間: {date_cond['column']} {date_cond['start_date']} 〜 {date_cond['end_date']} ({days}日間)")
         else:
             st.warning("⚠️ このテーブルには日付型カラムが見つかりませんでした")
             st.info("日付型カラムがない場合は、通常のフィルター条件を使用してください")
@@ -568,15 +815,15 @@ with colL:
     # WHERE句のGUI入力部分（日付以外の条件）
     st.markdown("#### フィルター条件 (WHERE句)")
     if selected_table:
-        table_cols = get_table_columns_with_types_cached(selected_table)
-        
-        # 既存の条件の表示
+        # 既存の条件の表示（削除ボタンは位置ではなく条件ごとのIDで識別する）
         for i, condition in enumerate(st.session_state.where_conditions_list):
             op = "WHERE" if i == 0 else condition['logic_op']
             quoted_col = quote_identifier(condition['column'])
             st.write(f"**{op.upper()}** `{quoted_col}` {condition['operator']} `'{condition['value']}'`")
-            if st.button("🗑️", key=f"del_cond_{i}"):
-                del st.session_state.where_conditions_list[i]
+            if st.button("🗑️", key=f"del_cond_{condition['id']}"):
+                st.session_state.where_conditions_list = [
+                    c for c in st.session_state.where_conditions_list if c['id'] != condition['id']
+                ]
                 st.rerun()
 
         # 新しい条件の追加フォーム（日付以外）
@@ -584,13 +831,13 @@ with colL:
             cond_logic_op = st.selectbox("論理演算子", ["AND", "OR"], key="cond_logic_op", disabled=(len(st.session_state.where_conditions_list) == 0))
             
             # 日付型以外のカラムのみを表示
-            non_date_columns = [col for col in table_cols if not is_date_like_column(col['name'], col['type'])]
             cond_col_name = st.selectbox("カラムを選択", [""] + sorted([c['name'] for c in non_date_columns]), key="cond_col_name")
             cond_operator = st.selectbox("演算子を選択", ["=", ">", "<", ">=", "<=", "<>", "LIKE"], key="cond_operator")
             cond_value = st.text_input("値を入力", key="cond_value")
             
             if st.button("追加", key="add_condition_btn") and cond_col_name and cond_value:
                 st.session_state.where_conditions_list.append({
+                    "id": uuid.uuid4().hex[:8],
                     "logic_op": cond_logic_op,
                     "column": cond_col_name,
                     "operator": cond_operator,
@@ -604,11 +851,13 @@ with colL:
     st.markdown("#### ソート条件 (ORDER BY句)")
     if selected_table:
         # 既存のソート条件の表示
-        for i, condition in enumerate(st.session_state.order_by_conditions_list):
+        for condition in st.session_state.order_by_conditions_list:
             quoted_col = quote_identifier(condition['column'])
             st.write(f"**ORDER BY** `{quoted_col}` **{condition['direction']}**")
-            if st.button("🗑️", key=f"del_sort_{i}"):
-                del st.session_state.order_by_conditions_list[i]
+            if st.button("🗑️", key=f"del_sort_{condition['id']}"):
+                st.session_state.order_by_conditions_list = [
+                    c for c in st.session_state.order_by_conditions_list if c['id'] != condition['id']
+                ]
                 st.rerun()
 
         # 新しいソート条件の追加フォーム
@@ -618,6 +867,7 @@ with colL:
             
             if st.button("追加", key="add_sort_btn") and sort_col_name:
                 st.session_state.order_by_conditions_list.append({
+                    "id": uuid.uuid4().hex[:8],
                     "column": sort_col_name,
                     "direction": sort_direction
                 })
@@ -630,64 +880,23 @@ with colR:
     st.markdown("#### 出力項目 (SELECT句)")
     selected_columns = []
     if selected_table:
-        basic_cols = get_table_columns_with_types_cached(selected_table)
-        cols_with_info = [{'name': c['name'], 'type': c['type']} for c in basic_cols]
-        
-        filter_text = st.text_input("カラム検索（部分一致）", key="col_filter_main")
-        if filter_text:
-            cols_with_info = [c for c in cols_with_info if filter_text.lower() in c['name'].lower()]
-        
-        c1, c2 = st.columns(2)
-        with c1:
-            if st.button("✅ 全選択", key="btn_select_all_cols_main"):
-                st.session_state.new_selected_columns_state = set([c['name'] for c in cols_with_info])
-                st.rerun()
-        with c2:
-            if st.button("🧹 全解除", key="btn_clear_cols_main"):
-                st.session_state.new_selected_columns_state = set()
-                st.rerun()
-
-        display_data = []
-        for c in cols_with_info:
-            is_selected = c['name'] in st.session_state.new_selected_columns_state
-            display_row = {
-                '選択': is_selected,
-                'カラム名': c['name'],
-                'データ型': c['type']
-            }
-            display_data.append(display_row)
-        
-        df_cols = pd.DataFrame(display_data)
-
-        if not df_cols.empty:
-            column_config = {
-                "選択": st.column_config.CheckboxColumn(
-                    "選択",
-                    help="表示するカラムを選択",
-                    default=False
-                ),
-                "カラム名": st.column_config.TextColumn("カラム名", width="medium"),
-                "データ型": st.column_config.TextColumn("データ型", width="small")
-            }
-
-            edited_df = st.data_editor(
-                df_cols,
-                column_config=column_config,
-                hide_index=True,
-                use_container_width=True,
-                key="column_selection_editor"
-            )
-
-            selected_names = {row['カラム名'] for _, row in edited_df.iterrows() if row['選択']}
-            st.session_state.new_selected_columns_state = selected_names
-            
-            selected_columns = sorted(list(st.session_state.new_selected_columns_state))
+        column_picker_fragment(table_cols)
+        selected_columns = sorted(st.session_state.new_selected_columns_state)
     else:
         st.info("テーブル/ビューを選択すると、カラム一覧が表示されます。")
 
 
 # SQLプレビュー・保存
 st.markdown("---")
+# 保存とプレビューで同じSQLを使うため、1回の再実行につき1回だけ生成する
+generated_query = build_standard_search_query(
+    table_schema,
+    selected_table,
+    st.session_state.date_condition,
+    st.session_state.where_conditions_list,
+    st.session_state.order_by_conditions_list,
+    selected_columns,
+) if selected_table else ""
 colA, colB = st.columns([1, 2])
 with colA:
     # 保存条件の判定
@@ -695,53 +904,6 @@ with colA:
     can_save = new_object_name and selected_table and has_date_condition
     
     if st.button("💾 保存", key="save_new_object_main", disabled=not can_save):
-        # WHERE句の生成
-        where_clauses = []
-        
-        # 日付条件を最初に追加（必須）
-        if 'date_condition' in st.session_state and st.session_state.date_condition:
-            date_cond = st.session_state.date_condition
-            quoted_date_col = quote_identifier(date_cond['column'])
-            date_clause = f"{quoted_date_col} BETWEEN '{date_cond['start_date']}' AND '{date_cond['end_date']}'"
-            where_clauses.append(date_clause)
-        
-        # その他の条件を追加
-        for i, cond in enumerate(st.session_state.where_conditions_list):
-            quoted_col = quote_identifier(cond['column'])
-            cond_str = f"{quoted_col} {cond['operator']}"
-            if cond['operator'].upper() == 'LIKE':
-                cond_str += f" '%{cond['value']}%'"
-            else:
-                cond_str += f" '{cond['value']}'"
-            
-            # 最初の条件以外は論理演算子を追加
-            if where_clauses:  # 日付条件がある場合はANDを追加
-                where_clauses.append(f"AND {cond_str}")
-            else:
-                where_clauses.append(cond_str)
-        
-        where_clause = " WHERE " + " ".join(where_clauses) if where_clauses else ""
-        
-        # ORDER BY句の生成
-        order_by_clauses = []
-        for cond in st.session_state.order_by_conditions_list:
-            quoted_col = quote_identifier(cond['column'])
-            order_by_clauses.append(f"{quoted_col} {cond['direction']}")
-        
-        order_by_clause = " ORDER BY " + ", ".join(order_by_clauses) if order_by_clauses else ""
-        
-        # SELECT句でカラム名をクォート
-        if selected_columns:
-            quoted_columns = [quote_identifier(col) for col in selected_columns]
-            select_clause = ", ".join(quoted_columns)
-        else:
-            select_clause = "*"
-        
-        # テーブル名もクォート（スキーマを含む完全修飾名を使用）
-        quoted_table = quote_identifier(selected_table)
-        table_schema = get_table_schema(selected_table)
-        generated_query = f"SELECT {select_clause} FROM {table_schema}.{quoted_table}{where_clause}{order_by_clause}"
-
         object_data = {
             'object_id': f"obj_{uuid.uuid4().hex[:12]}",
             'object_name': new_object_name,
@@ -751,6 +913,7 @@ with colA:
         if save_standard_search_object(object_data):
             st.success("検索オブジェクトを保存しました！")
             st.session_state.new_selected_columns_state = set()
+            st.session_state.pop('col_multiselect', None)
             st.session_state.where_conditions_list = []
             st.session_state.order_by_conditions_list = []
             st.session_state.date_condition = {}
@@ -766,57 +929,11 @@ with colA:
 with colB:
     st.markdown("#### 📝 SQLプレビュー")
     if selected_table:
-        # WHERE句の生成
-        where_clauses = []
-        
-        # 日付条件を最初に追加（必須）
-        if 'date_condition' in st.session_state and st.session_state.date_condition:
-            date_cond = st.session_state.date_condition
-            quoted_date_col = quote_identifier(date_cond['column'])
-            date_clause = f"{quoted_date_col} BETWEEN '{date_cond['start_date']}' AND '{date_cond['end_date']}'"
-            where_clauses.append(date_clause)
-        
-        # その他の条件を追加
-        for i, cond in enumerate(st.session_state.where_conditions_list):
-            quoted_col = quote_identifier(cond['column'])
-            cond_str = f"{quoted_col} {cond['operator']}"
-            if cond['operator'].upper() == 'LIKE':
-                cond_str += f" '%{cond['value']}%'"
-            else:
-                cond_str += f" '{cond['value']}'"
-            
-            # 最初の条件以外は論理演算子を追加
-            if where_clauses:  # 日付条件がある場合はANDを追加
-                where_clauses.append(f"AND {cond_str}")
-            else:
-                where_clauses.append(cond_str)
-        
-        where_clause = " WHERE " + " ".join(where_clauses) if where_clauses else ""
-        
-        # ORDER BY句の生成
-        order_by_clauses = []
-        for cond in st.session_state.order_by_conditions_list:
-            quoted_col = quote_identifier(cond['column'])
-            order_by_clauses.append(f"{quoted_col} {cond['direction']}")
-        
-        order_by_clause = " ORDER BY " + ", ".join(order_by_clauses) if order_by_clauses else ""
-        
-        # SELECT句でカラム名をクォート
-        if selected_columns:
-            quoted_columns = [quote_identifier(col) for col in selected_columns]
-            select_clause = ", ".join(quoted_columns)
-        else:
-            select_clause = "*"
-        
-        # テーブル名もクォート（スキーマを含む完全修飾名を使用）
-        quoted_table = quote_identifier(selected_table)
-        table_schema = get_table_schema(selected_table)
-        generated_query = f"SELECT {select_clause} FROM {table_schema}.{quoted_table}{where_clause}{order_by_clause}"
         st.code(generated_query, language="sql")
         
         # ソート条件がある場合は追加情報を表示
-        if order_by_clauses:
-            st.info(f"📊 ソート条件: {len(order_by_clauses)}件設定済み")
+        if st.session_state.order_by_conditions_list:
+            st.info(f"📊 ソート条件: {len(st.session_state.order_by_conditions_list)}件設定済み")
     else:
         st.info("テーブル/ビューを選択するとSQLプレビューが表示されます。")
 
@@ -825,46 +942,32 @@ st.markdown("---")
 # =========================================================
 # タブ
 # =========================================================
+# 一覧とお気に入りは同じ取得結果を使う（テーブルはsetup SQLで事前作成済み）
+try:
+    objects = load_standard_search_objects()
+except Exception as e:
+    st.error(f"定型検索オブジェクト取得エラー: {str(e)}")
+    objects = []
+favorite_objects = [obj for obj in objects if obj['IS_FAVORITE']]
+
 tab1, tab3 = st.tabs(["📋 オブジェクト一覧", "⭐ お気に入り"])
 # tab2 = スケジュール実行タブ（機能不要のためコメントアウト）
 
 with tab1:
     st.subheader("📋 定型検索オブジェクト一覧")
-    # テーブルはsetup SQLで事前作成済み
-    objects = load_standard_search_objects()
     if objects:
+        created_labels = format_timestamps([obj['CREATED_AT'] for obj in objects])
+        last_executed_labels = format_timestamps([obj['LAST_EXECUTED'] for obj in objects])
         for i, obj in enumerate(objects):
             with st.expander(f"🔍 {obj['OBJECT_NAME']} ({obj['OBJECT_ID']})", expanded=False):
                 col1, col2 = st.columns([3, 2])
                 with col1:
                     st.write(f"**説明**: {obj['DESCRIPTION'] or '説明なし'}")
-                    # 作成日を日時（hh:mm）まで表示
-                    created_at = obj['CREATED_AT']
-                    if created_at:
-                        if isinstance(created_at, str):
-                            try:
-                                from datetime import datetime
-                                created_dt = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-                                formatted_date = created_dt.strftime('%Y-%m-%d %H:%M')
-                            except:
-                                formatted_date = str(created_at)[:16]  # フォールバック
-                        else:
-                            formatted_date = created_at.strftime('%Y-%m-%d %H:%M')
-                    else:
-                        formatted_date = "不明"
-                    st.write(f"**作成日**: {formatted_date}")
+                    # 作成日を日時（hh:mm）まで表示（一覧分をまとめて整形済み）
+                    st.write(f"**作成日**: {created_labels[i] or '不明'}")
                     st.write(f"**実行回数**: {obj['EXECUTION_COUNT']}")
-                    if obj['LAST_EXECUTED']:
-                        last_executed = obj['LAST_EXECUTED']
-                        if isinstance(last_executed, str):
-                            try:
-                                last_dt = datetime.fromisoformat(last_executed.replace('Z', '+00:00'))
-                                formatted_last = last_dt.strftime('%Y-%m-%d %H:%M')
-                            except:
-                                formatted_last = str(last_executed)[:16]
-                        else:
-                            formatted_last = last_executed.strftime('%Y-%m-%d %H:%M')
-                        st.write(f"**最終実行**: {formatted_last}")
+                    if last_executed_labels[i]:
+                        st.write(f"**最終実行**: {last_executed_labels[i]}")
                     
                     with col2:
                         all_rows = st.checkbox("全件取得 (LIMIT無効、非推奨)", value=False, key=f"allrows_{i}")
@@ -876,7 +979,7 @@ with tab1:
                             st.markdown("**📝 実行予定SQL:**")
                             # LIMIT句を考慮したSQLを生成
                             base_query = obj['SEARCH_QUERY']
-                            if not all_rows and " LIMIT " not in base_query.upper():
+                            if not all_rows and not obj['HAS_LIMIT']:
                                 display_query = f"{base_query} LIMIT {int(limit_rows)}"
                             else:
                                 display_query = base_query
@@ -898,8 +1001,6 @@ with tab1:
 
                     fav_col = st.columns(1)[0]
                     with fav_col:
-                        if 'favorites' not in st.session_state:
-                            st.session_state.favorites = []
                         if obj['IS_FAVORITE']:
                             st.write("⭐ お気に入り済み")
                         else:
@@ -913,42 +1014,20 @@ with tab1:
 
 with tab3:
     st.subheader("⭐ お気に入り")
-    # テーブルはsetup SQLで事前作成済み
-    favorite_objects = session.sql("SELECT * FROM application_db.application_schema.STANDARD_SEARCH_OBJECTS WHERE is_favorite = TRUE ORDER BY created_at DESC").collect()
     if favorite_objects:
             st.success(f"お気に入り: {len(favorite_objects)}件")
+            created_labels = format_timestamps([obj['CREATED_AT'] for obj in favorite_objects])
+            last_executed_labels = format_timestamps([obj['LAST_EXECUTED'] for obj in favorite_objects])
             for i, obj in enumerate(favorite_objects):
                 with st.expander(f"⭐ {obj['OBJECT_NAME']} ({obj['OBJECT_ID']})", expanded=False):
                     col1, col2 = st.columns([3, 2])
                     with col1:
                         st.write(f"**説明**: {obj['DESCRIPTION'] or '説明なし'}")
-                        # 作成日を日時（hh:mm）まで表示
-                        created_at = obj['CREATED_AT']
-                        if created_at:
-                            if isinstance(created_at, str):
-                                try:
-                                    from datetime import datetime
-                                    created_dt = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-                                    formatted_date = created_dt.strftime('%Y-%m-%d %H:%M')
-                                except:
-                                    formatted_date = str(created_at)[:16]  # フォールバック
-                            else:
-                                formatted_date = created_at.strftime('%Y-%m-%d %H:%M')
-                        else:
-                            formatted_date = "不明"
-                        st.write(f"**作成日**: {formatted_date}")
+                        # 作成日を日時（hh:mm）まで表示（一覧分をまとめて整形済み）
+                        st.write(f"**作成日**: {created_labels[i] or '不明'}")
                         st.write(f"**実行回数**: {obj['EXECUTION_COUNT']}")
-                        if obj['LAST_EXECUTED']:
-                            last_executed = obj['LAST_EXECUTED']
-                            if isinstance(last_executed, str):
-                                try:
-                                    last_dt = datetime.fromisoformat(last_executed.replace('Z', '+00:00'))
-                                    formatted_last = last_dt.strftime('%Y-%m-%d %H:%M')
-                                except:
-                                    formatted_last = str(last_executed)[:16]
-                            else:
-                                formatted_last = last_executed.strftime('%Y-%m-%d %H:%M')
-                            st.write(f"**最終実行**: {formatted_last}")
+                        if last_executed_labels[i]:
+                            st.write(f"**最終実行**: {last_executed_labels[i]}")
                     with col2:
                         all_rows = st.checkbox("全件取得 (LIMIT無効、非推奨)", value=False, key=f"fav_allrows_{i}")
                         limit_rows = st.number_input("LIMIT行数", min_value=10, max_value=5000, value=5000, step=10, key=f"fav_limit_{i}", disabled=all_rows)
@@ -959,7 +1038,7 @@ with tab3:
                             st.markdown("**📝 実行予定SQL:**")
                             # LIMIT句を考慮したSQLを生成
                             base_query = obj['SEARCH_QUERY']
-                            if not all_rows and " LIMIT " not in base_query.upper():
+                            if not all_rows and not obj['HAS_LIMIT']:
                                 display_query = f"{base_query} LIMIT {int(limit_rows)}"
                             else:
                                 display_query = base_query
@@ -1001,8 +1080,10 @@ st.markdown("---")
 st.subheader("📄 出力結果")
 if st.session_state.last_result_df is not None:
     st.dataframe(st.session_state.last_result_df, use_container_width=True, height=600)
-    csv = st.session_state.last_result_df.to_csv(index=False)
-    st.download_button(label="💾 CSVダウンロード", data=csv, file_name=f"result_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv", mime="text/csv")
+    # CSVは結果ごとに1回だけ生成し、以降の再実行では使い回す
+    if st.session_state.last_result_csv is None:
+        st.session_state.last_result_csv = st.session_state.last_result_df.to_csv(index=False).encode('utf-8')
+    st.download_button(label="💾 CSVダウンロード", data=st.session_state.last_result_csv, file_name=f"result_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv", mime="text/csv")
 else:
     st.info("ここに最新の実行結果を表示します。上部で検索を実行してください。")
 
@@ -9,10 +9,14 @@
 import streamlit as st
 import pandas as pd
 import json
+import re
+import uuid
 import time
 from datetime import datetime, timedelta
 from snowflake.snowpark.context import get_active_session
 from snowflake.snowpark.functions import col, lit
+from collections import Counter
+from functools import lru_cache
 
 st.set_page_config(layout="wide", page_title="📊 非定型検索", page_icon="📊")
 
@@ -25,12 +29,17 @@ session = get_snowflake_session()
 # =========================================================
 # 定数定義: データスキーマ（デフォルト値として保持）
 # =========================================================
-DEFAULT_DATA_SCHEMA = "bank_db.bank_schema"
-APP_DATA_SCHEMA = "application_db.application_schema"
+# （SHOWの結果と同じく、未クォート識別子が解決される大文字表記で保持する。DB名はクォートしてSQLに埋め込むため）
+DEFAULT_DATA_SCHEMA = "BANK_DB.BANK_SCHEMA"
+APP_DATA_SCHEMA = "APPLICATION_DB.APPLICATION_SCHEMA"
 # 検索対象から除外するシステムテーブル
-SYSTEM_TABLES = {"STANDARD_SEARCH_OBJECTS", "ADHOC_SEARCH_OBJECTS", "ANNOUNCEMENTS"}
-# 検索対象から除外するテーブル名のプレフィックス
+SYSTEM_TABLES = frozenset({"STANDARD_SEARCH_OBJECTS", "ADHOC_SEARCH_OBJECTS", "ANNOUNCEMENTS"})
+# 検索対象から除外するテーブル名のプレフィックス（str.startswithにそのまま渡せるようタプルで保持）
 EXCLUDED_PREFIXES = ("SNOWPARK_TEMP_TABLE_",)
+# STEP 3のカラム選択エディタのキー（固定し、行構成が変わる時だけ明示的にリセットする）
+ADHOC_COLUMN_EDITOR_KEY = "adhoc_column_selection_editor"
+# LIMIT句の有無の判定用（末尾のLIMIT句のみを対象にし、"LIMIT"カラムや'no limit'等のリテラルには反応しない）
+_LIMIT_RE = re.compile(r"\bLIMIT\s+\d+(?:\s+OFFSET\s+\d+)?\s*;?\s*$", re.IGNORECASE)
 
 # =========================================================
 # DB/スキーマ動的選択のヘルパー関数
@@ -60,31 +69,83 @@ def get_available_schemas(database_name: str):
         return []
 
 @st.cache_data(ttl=60, show_spinner=False)
+def _fetch_relations_concurrent(database: str, schema: str):
+    """指定スキーマのテーブル名・ビュー名を取得（2つのSHOWを非同期で同時に発行）"""
+    # nameしか使わないため、列の少ないTERSE版で取得する
+    try:
+        tables_job = session.sql(f"SHOW TERSE TABLES IN {database}.{schema}").collect_nowait()
+    except:
+        tables_job = None
+    try:
+        views_job = session.sql(f"SHOW TERSE VIEWS IN {database}.{schema}").collect_nowait()
+    except:
+        views_job = None
+    try:
+        tables_rows = tables_job.result() if tables_job else []
+    except:
+        tables_rows = []
+    try:
+        views_rows = views_job.result() if views_job else []
+    except:
+        views_rows = []
+    tables = sorted(
+        name for row in tables_rows
+        if (name := row['name']) not in SYSTEM_TABLES and not name.upper().startswith(EXCLUDED_PREFIXES)
+    )
+    views = sorted(row['name'] for row in views_rows)
+    return tables, views
+
+@st.cache_data(ttl=60, show_spinner=False)
+def _db_catalog(database: str):
+    """DB内の全スキーマのテーブル名・ビュー名をINFORMATION_SCHEMAから1回で取得（戻り値: (スキーマ名→(テーブル, ビュー), エラー内容)）"""
+    try:
+        # DB名はSHOW DATABASESの結果そのままのため、小文字・記号を含む名前も扱えるようクォートする
+        result = session.sql(f"""
+            SELECT table_schema, table_name, table_type
+            FROM {quote_identifier(database)}.INFORMATION_SCHEMA.TABLES
+            WHERE table_schema <> 'INFORMATION_SCHEMA'
+            ORDER BY table_schema, table_name
+        """).collect()
+    except Exception as e:
+        # オブジェクト数が多すぎる場合などはエラー内容を返し、スキーマ単位のSHOWにフォールバックさせる
+        return None, str(e)
+    catalog = {}
+    for row in result:
+        tables, views = catalog.setdefault(row['TABLE_SCHEMA'], ([], []))
+        name, table_type = row['TABLE_NAME'], row['TABLE_TYPE']
+        if table_type.endswith('VIEW'):
+            views.append(name)
+        elif table_type != 'EXTERNAL TABLE' and name not in SYSTEM_TABLES and not name.upper().startswith(EXCLUDED_PREFIXES):
+            tables.append(name)
+    return catalog, None
+
+# カタログ取得失敗の警告を表示済みのDB（ページの再実行毎に空に戻る）
+_catalog_warned_databases = set()
+
+def _fetch_relations(database: str, schema: str):
+    """指定スキーマのテーブル名・ビュー名を取得（DB単位のカタログを優先し、取得できない場合はSHOWで取得）"""
+    catalog, error = _db_catalog(database)
+    if catalog is not None:
+        return catalog.get(schema, ([], []))
+    # テーブル一覧・ビュー一覧の両方から呼ばれるため、警告は1回の実行につきDB毎に1回だけ表示する
+    if database not in _catalog_warned_databases:
+        _catalog_warned_databases.add(database)
+        st.warning(f"⚠️ INFORMATION_SCHEMAからの一覧取得に失敗したため、SHOWで取得します: {error}")
+    return _fetch_relations_concurrent(database, schema)
+
+# 一覧の取得結果は_db_catalog / _fetch_relations_concurrent側でキャッシュ済みのため、ここではキャッシュしない
+# （キャッシュを重ねると、新しく作成したテーブルが表示されるまでの時間が各TTLの合計まで延びる）
 def get_available_tables_dynamic(database: str, schema: str):
     """指定スキーマのテーブル一覧を取得"""
     if not database or not schema:
         return []
-    try:
-        result = session.sql(f"SHOW TABLES IN {database}.{schema}").collect()
-        tables = []
-        for row in result:
-            name = row['name']
-            if name not in SYSTEM_TABLES and not name.upper().startswith(EXCLUDED_PREFIXES):
-                tables.append(name)
-        return sorted(tables)
-    except:
-        return []
+    return _fetch_relations(database, schema)[0]
 
-@st.cache_data(ttl=60, show_spinner=False)
 def get_available_views_dynamic(database: str, schema: str):
     """指定スキーマのビュー一覧を取得"""
     if not database or not schema:
         return []
-    try:
-        result = session.sql(f"SHOW VIEWS IN {database}.{schema}").collect()
-        return sorted([row['name'] for row in result])
-    except:
-        return []
+    return _fetch_relations(database, schema)[1]
 
 def get_current_data_schema():
     """現在選択されているデータスキーマを取得（DB.SCHEMA形式）"""
@@ -92,6 +153,7 @@ def get_current_data_schema():
         return f"{st.session_state.selected_database}.{st.session_state.selected_schema}"
     return DEFAULT_DATA_SCHEMA
 
+@lru_cache(maxsize=4096)
 def quote_identifier(identifier: str) -> str:
     """SQL識別子（テーブル名、カラム名）を適切にクォートする"""
     if not identifier:
@@ -106,91 +168,372 @@ def quote_identifier(identifier: str) -> str:
     return f'"{escaped_identifier}"'
 
 # セッション状態の初期化（3テーブル結合対応）
-if 'selected_table1' not in st.session_state:
-    st.session_state.selected_table1 = ""
-if 'selected_table2' not in st.session_state:
-    st.session_state.selected_table2 = ""
-if 'selected_table3' not in st.session_state:
-    st.session_state.selected_table3 = ""
-if 'join_key1' not in st.session_state:
-    st.session_state.join_key1 = ""
-if 'join_key2' not in st.session_state:
-    st.session_state.join_key2 = ""
-if 'join_key3' not in st.session_state:
-    st.session_state.join_key3 = ""
-if 'join_type1' not in st.session_state:
-    st.session_state.join_type1 = "INNER JOIN"
-if 'join_type2' not in st.session_state:
-    st.session_state.join_type2 = "INNER JOIN"
-if 'search_result_df' not in st.session_state:
-    st.session_state.search_result_df = None
-if 'work_table_selection' not in st.session_state:
-    st.session_state.work_table_selection = ""
-# WHERE条件とソート条件の管理（1_standard_search.pyと同じロジック）
-if 'adhoc_where_conditions_list' not in st.session_state:
-    st.session_state.adhoc_where_conditions_list = []
-if 'adhoc_order_by_conditions_list' not in st.session_state:
-    st.session_state.adhoc_order_by_conditions_list = []
-if 'adhoc_group_by_conditions_list' not in st.session_state:
-    st.session_state.adhoc_group_by_conditions_list = []
-if 'enable_3table_join' not in st.session_state:
-    st.session_state.enable_3table_join = False
-if 'join_key2_for_join2' not in st.session_state:
-    st.session_state.join_key2_for_join2 = ""
-if 'adhoc_selected_columns' not in st.session_state:
-    st.session_state.adhoc_selected_columns = set()
-if 'active_tab' not in st.session_state:
-    st.session_state.active_tab = "📄 検索結果"
-
-# DB/スキーマ選択のセッション状態
-if 'selected_database' not in st.session_state:
-    st.session_state.selected_database = ""
-if 'selected_schema' not in st.session_state:
-    st.session_state.selected_schema = ""
+# 未設定のキーのみ初期値を入れる（リスト/セット等はこのdictごと毎回新しく作られるため共有されない）
+for key, default in {
+    'selected_table1': "",
+    'selected_table2': "",
+    'selected_table3': "",
+    'join_key1': "",
+    'join_key2': "",
+    'join_key3': "",
+    'join_type1': "INNER JOIN",
+    'join_type2': "INNER JOIN",
+    'search_result_df': None,
+    'work_table_selection': "",
+    # WHERE条件とソート条件の管理（1_standard_search.pyと同じロジック）
+    'adhoc_where_conditions_list': [],
+    'adhoc_order_by_conditions_list': [],
+    'adhoc_group_by_conditions_list': [],
+    'enable_3table_join': False,
+    'join_key2_for_join2': "",
+    'adhoc_selected_columns': set(),
+    'active_tab': "📄 検索結果",
+    # DB/スキーマ選択のセッション状態
+    'selected_database': "",
+    'selected_schema': "",
+}.items():
+    st.session_state.setdefault(key, default)
 
 # check_table_exists関数は削除 - setup SQLで事前作成済み
 
-def is_excluded_table_early(table_name: str) -> bool:
-    """除外対象のテーブルかどうかを判定（get_available_tables用）"""
-    if table_name in SYSTEM_TABLES:
-        return True
-    if table_name.upper().startswith(EXCLUDED_PREFIXES):
-        return True
-    return False
-
-def get_available_tables():
-    """選択されたスキーマからテーブル名を取得"""
-    selected_db = st.session_state.get('selected_database', '')
-    selected_schema = st.session_state.get('selected_schema', '')
-    
-    if selected_db and selected_schema:
-        return get_available_tables_dynamic(selected_db, selected_schema)
-    else:
-        return []
+# カラム一括取得失敗の警告を表示済みのDB（ページの再実行毎に空に戻る）
+_column_bulk_warned_databases = set()
 
 def get_table_columns(table_name: str):
+    """テーブル/ビューのカラム名とデータ型を取得（選択中のDB/スキーマとテーブル名の組でキャッシュ）"""
+    database, _, schema = get_current_data_schema().partition('.')
+    # STEP 1で選択中のテーブルは1回のINFORMATION_SCHEMA.COLUMNS参照でまとめて取得する
+    selected = [st.session_state.selected_table1, st.session_state.selected_table2]
+    if st.session_state.enable_3table_join:
+        selected.append(st.session_state.selected_table3)
+    if table_name in selected:
+        bulk, error = get_columns_bulk(database, schema, tuple(sorted({t for t in selected if t and not t.startswith('"')})))
+        # 選択中の各テーブルから呼ばれるため、警告は1回の実行につきDB毎に1回だけ表示する
+        if error and database not in _column_bulk_warned_databases:
+            _column_bulk_warned_databases.add(database)
+            st.warning(f"⚠️ INFORMATION_SCHEMAからのカラム一括取得に失敗したため、テーブル毎に取得します: {error}")
+        if table_name in bulk:
+            return bulk[table_name]
+    return _get_table_columns_cached(database, schema, table_name)
+
+def get_column_display_df(table_name: str) -> pd.DataFrame:
+    """カラム情報表示用のDataFrameを取得（カラム構成が同じ間はキャッシュ済みのDataFrameを返す）"""
+    return _column_display_df(tuple((c['name'], c['type']) for c in get_table_columns(table_name)))
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _column_display_df(columns: tuple) -> pd.DataFrame:
+    """カラム名・データ型の表示用DataFrameを作成"""
+    return pd.DataFrame(
+        [{'カラム名': name, 'データ型': data_type} for name, data_type in columns],
+        columns=['カラム名', 'データ型']
+    )
+
+def _describe_style_type(row) -> str:
+    """INFORMATION_SCHEMA.COLUMNSの型情報をDESCRIBE TABLEと同じ形式の型名に変換"""
+    data_type = row['DATA_TYPE']
+    if data_type == 'NUMBER':
+        return f"NUMBER({row['NUMERIC_PRECISION']},{row['NUMERIC_SCALE']})"
+    if data_type == 'TEXT':
+        return f"VARCHAR({row['CHARACTER_MAXIMUM_LENGTH']})"
+    if data_type == 'BINARY':
+        return f"BINARY({row['CHARACTER_MAXIMUM_LENGTH']})"
+    if data_type in ('TIME', 'TIMESTAMP_NTZ', 'TIMESTAMP_LTZ', 'TIMESTAMP_TZ'):
+        return f"{data_type}({row['DATETIME_PRECISION']})"
+    return data_type
+
+@st.cache_data(ttl=300, show_spinner=False)
+def get_columns_bulk(database: str, schema: str, tables: tuple) -> tuple:
+    """複数テーブル/ビューのカラム名とデータ型を1回のクエリで取得（戻り値: (テーブル名→カラム一覧, エラー内容)）"""
+    if not database or not schema or not tables:
+        return {}, None
+    placeholders = ", ".join(["?"] * len(tables))
+    columns = {}
     try:
-        quoted_table = f'"{table_name}"' if not table_name.startswith('"') else table_name
-        # テーブルのスキーマを動的に判定
-        schema = get_table_schema(table_name)
-        result = session.sql(f"DESCRIBE TABLE {schema}.{quoted_table}").collect()
-        return [{'name': row['name'], 'type': row['type']} for row in result]
-    except:
-        return []
+        # DB名はSHOW DATABASESの結果そのままのため、小文字・記号を含む名前も扱えるようクォートする
+        result = session.sql(f"""
+            SELECT table_name, column_name, data_type, character_maximum_length,
+                   numeric_precision, numeric_scale, datetime_precision
+            FROM {quote_identifier(database)}.INFORMATION_SCHEMA.COLUMNS
+            WHERE table_schema = ? AND table_name IN ({placeholders})
+            ORDER BY table_name, ordinal_position
+        """, params=[schema, *tables]).collect()
+    except Exception as e:
+        # 取得できない場合はエラー内容を返し、テーブル毎のDESCRIBEにフォールバックさせる
+        return {}, str(e)
+    for row in result:
+        columns.setdefault(row['TABLE_NAME'], []).append(
+            {'name': row['COLUMN_NAME'], 'type': _describe_style_type(row)}
+        )
+    return columns, None
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _get_table_columns_cached(database: str, schema: str, table_name: str):
+    """指定DB/スキーマのテーブル/ビューをDESCRIBEしてカラム名とデータ型を取得"""
+    quoted_table = f'"{table_name}"' if not table_name.startswith('"') else table_name
+    # スキーマ判定のための事前DESCRIBEは行わず、選択中のスキーマ→システムテーブル用スキーマの順に直接取得する
+    for qualified_schema in (f"{database}.{schema}", APP_DATA_SCHEMA):
+        try:
+            result = session.sql(f"DESCRIBE TABLE {qualified_schema}.{quoted_table}").collect()
+            return [{'name': row['name'], 'type': row['type']} for row in result]
+        except:
+            continue
+    return []
+
+# 型・カラム名判定用のキーワード（呼び出し毎にリストを作らないようモジュールで1回だけ定義）
+_DATE_TYPES = frozenset({
+    'DATE', 'DATETIME', 'TIMESTAMP', 'TIMESTAMP_NTZ', 'TIMESTAMP_LTZ', 'TIMESTAMP_TZ',
+    'TIME', 'DATETIME_NTZ', 'DATETIME_LTZ', 'DATETIME_TZ'
+})
+_DATE_KEYWORDS = frozenset({
+    'DATE', 'DT', '日付', '年月日', 'YMD', 'YYYYMMDD',
+    '_AT', 'CREATED', 'UPDATED', 'REGISTERED', 'TIMESTAMP',
+    '登録日', '更新日', '作成日', '開始日', '終了日', '取引日', '発生日'
+})
+_NUMERIC_TYPES = frozenset({
+    'NUMBER', 'INT', 'INTEGER', 'BIGINT', 'SMALLINT', 'TINYINT',
+    'FLOAT', 'DOUBLE', 'DECIMAL', 'NUMERIC'
+})
+
+def column_fingerprint(columns: list) -> tuple:
+    """カラム構成（カラム名と型）をメモ化のキーに使える形にする（件数だけではカラム名・型の変更を検知できないため）"""
+    return tuple((c['name'], c['type']) for c in columns)
+
+@lru_cache(maxsize=4096)
+def _parse_selected_column(selected_col: str) -> tuple:
+    """選択カラムのSQL表現（例: t1."COL" AS "t1_COL"）から（テーブル別名, 元のカラム名）を取り出す"""
+    alias, _, col_part = selected_col.partition('.')
+    # 別名部分を除去し、クォートを外して元のカラム名に戻す
+    col_part = col_part.split(' AS ', 1)[0]
+    if col_part.startswith('"') and col_part.endswith('"'):
+        col_part = col_part[1:-1].replace('""', '"')
+    return alias, col_part
+
+def split_selected_columns(selected_columns) -> dict:
+    """STEP 3の選択カラムをテーブル別名毎の元カラム名の集合に分ける"""
+    # STEP 3でカラム一覧を作る際に保持した対応表を引く（対応表にない場合のみSQL表現を解析する）
+    lookup = st.session_state.get('_adhoc_selected_name_lookup', {})
+    names = {'t1': set(), 't2': set(), 't3': set()}
+    for selected_col in selected_columns:
+        alias, col_name = lookup.get(selected_col) or _parse_selected_column(selected_col)
+        if alias in names:
+            names[alias].add(col_name)
+    return {alias: frozenset(cols) for alias, cols in names.items()}
+
+def build_condition_columns(condition_tables: list, picked_names: dict = None) -> list:
+    """STEP 4の条件設定で使うカラム情報を作成（picked_names指定時はSTEP 3で選択されたカラムのみ）"""
+    all_columns = []
+    for alias, table_name, columns in condition_tables:
+        picked = picked_names[alias] if picked_names is not None else None
+        for col in columns:
+            if picked is not None and col['name'] not in picked:
+                continue
+            all_columns.append({
+                'name': col['name'],
+                'type': col['type'],
+                'table': table_name,
+                'qualified_name': f"{table_name}.{col['name']}",
+                # 数値型かどうかは作成時に1回だけ判定しておく（集計対象の絞り込み用）
+                'is_numeric': is_numeric_type(col['type'])
+            })
+    return all_columns
+
+def to_alias_column(col_with_alias: str, alias_map: dict) -> str:
+    """「テーブル名.カラム名」をSQL内のエイリアス付きカラム（例: t1."カラム名"）に変換する"""
+    table_name, sep, col_name = col_with_alias.partition('.')
+    alias = alias_map.get(table_name) if sep else None
+    if alias:
+        return f"{alias}.{quote_identifier(col_name)}"
+    return quote_identifier(col_with_alias)
+
+def quote_literal(value) -> str:
+    """値をSQLの文字列リテラルにする（バックスラッシュとシングルクォートをエスケープ）"""
+    # Snowflakeの文字列リテラルではバックスラッシュもエスケープ文字のため、先に二重化してから ' を '' にする
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "''") + "'"
+
+def _render_like_condition(alias_col: str, value: str) -> str:
+    """LIKE条件を生成（ユーザーが手動で%を指定している場合はそのまま使用、そうでなければ自動で%を付与）"""
+    like_value = value if value[:1] == '%' or value[-1:] == '%' else f"%{value}%"
+    return f"{alias_col} LIKE {quote_literal(like_value)}"
+
+def _render_in_condition(alias_col: str, value: str) -> str:
+    """IN条件を生成（「'A','B','C'」のような入力をカンマで分割し、各値をリテラルとして埋め込み直す）"""
+    items = []
+    for item in value.split(','):
+        item = item.strip()
+        # 入力例に合わせて前後の引用符（と引用符の二重化）は外し、値の部分だけをエスケープし直す
+        if len(item) >= 2 and item[0] == item[-1] and item[0] in ("'", '"'):
+            item = item[1:-1].replace(item[0] * 2, item[0])
+        if item:
+            items.append(quote_literal(item))
+    return f"{alias_col} IN ({', '.join(items) or quote_literal('')})"
+
+# WHERE条件の演算子毎の条件式生成（ここにない比較演算子は「カラム 演算子 '値'」で生成する）
+WHERE_OPERATOR_RENDERERS = {
+    "IS NULL": lambda alias_col, value: f"{alias_col} IS NULL",
+    "IS NOT NULL": lambda alias_col, value: f"{alias_col} IS NOT NULL",
+    "LIKE": _render_like_condition,
+    "IN": _render_in_condition,
+}
+
+def render_where_condition(alias_col: str, operator: str, value: str) -> str:
+    """WHERE条件1件分の条件式を生成する"""
+    renderer = WHERE_OPERATOR_RENDERERS.get(operator)
+    if renderer:
+        return renderer(alias_col, value)
+    return f"{alias_col} {operator} {quote_literal(value)}"
+
+@st.cache_data(ttl=300, show_spinner=False)
+def build_join_sql(config_json: str) -> tuple:
+    """STEP 5の結合SQLを生成する（設定をまとめたJSONをキーにキャッシュし、同じ設定なら再生成しない）"""
+    config = json.loads(config_json)
+    # tables: [[エイリアス, テーブル名, スキーマ付きテーブル名, 全カラム名]]（全カラム名はカラム未選択時のみ使用）
+    tables = config['tables']
+    duplicate_cols = set(config['duplicate_cols'])
+    group_by_conditions = config['group_by']
+    # テーブル名→エイリアス（同じテーブルが複数回選ばれた場合は先頭のエイリアスを使う）
+    alias_map = {table_name: alias for alias, table_name, _, _ in reversed(tables)}
+    quoted_tables = {alias: quoted_table for alias, _, quoted_table, _ in tables}
+    
+    # SELECT句を構築（選択されたカラムのみ）
+    if config['selected_columns']:
+        select_clause = "SELECT " + ",\n       ".join(config['selected_columns'])
+    else:
+        # カラム未選択の場合は全カラム（重複カラムはテーブル毎に別名を付与）
+        select_parts = []
+        for alias, _, _, column_names in tables:
+            for col_name in column_names:
+                quoted_col = quote_identifier(col_name)
+                if col_name in duplicate_cols:
+                    alias_name = f"{alias}_{col_name}"
+                    select_parts.append(f"{alias}.{quoted_col} AS {quote_identifier(alias_name)}")
+                else:
+                    select_parts.append(f"{alias}.{quoted_col}")
+        select_clause = "SELECT " + ",\n       ".join(select_parts)
+    
+    # FROM句とJOIN句（joins: [[結合種別, 左エイリアス, 左キー, 右エイリアス, 右キー]]）
+    from_lines = [f"FROM {quoted_tables['t1']} t1"]
+    for join_type, left_alias, left_key, right_alias, right_key in config['joins']:
+        from_lines += [
+            f"{join_type} {quoted_tables[right_alias]} {right_alias} ",
+            f"ON {left_alias}.{quote_identifier(left_key)} = {right_alias}.{quote_identifier(right_key)}",
+        ]
+    
+    # 各句を個別に保持し、最後に1回だけ連結する（GROUP BY時はSELECT句を差し替えるだけで済む）
+    sql_parts = {
+        'select': select_clause,
+        'from': "\n".join(from_lines),
+        'where': None,
+        'group_by': None,
+        'order_by': None,
+    }
+    
+    # WHERE句の追加
+    if config['where']:
+        where_clauses = []
+        for i, condition in enumerate(config['where']):
+            # テーブル名.カラム名の形式でエイリアスを考慮（例: "テーブル1.カラム名" → t1."カラム名"）
+            alias_col = to_alias_column(condition['column'], alias_map)
+            cond_str = render_where_condition(alias_col, condition['operator'], condition['value'])
+            
+            if i == 0:
+                where_clauses.append(cond_str)
+            else:
+                where_clauses.append(f"{condition['logic_op']} {cond_str}")
+        
+        sql_parts['where'] = f"WHERE {' '.join(where_clauses)}"
+    
+    # GROUP BY句の追加
+    if group_by_conditions:
+        group_by_columns = []
+        aggregate_columns = []
+        
+        for condition in group_by_conditions:
+            # 新しいデータ構造と古いデータ構造の両方に対応
+            if 'group_column' in condition:
+                # 新しいデータ構造
+                if condition.get('is_grouping_column', False):
+                    # グルーピングカラムの場合
+                    group_by_columns.append(to_alias_column(condition['group_column'], alias_map))
+                
+                elif condition.get('aggregate_func'):
+                    # 集計関数の場合
+                    agg_func = condition['aggregate_func']
+                    agg_col_with_alias = condition['aggregate_column']
+                    agg_alias_col = "*" if agg_col_with_alias == "*" else to_alias_column(agg_col_with_alias, alias_map)
+                    
+                    # 集計関数を適用
+                    if agg_func == "COUNT_DISTINCT":
+                        alias_name = f"count_distinct_{agg_col_with_alias.replace('.', '_')}"
+                        agg_expression = f"COUNT(DISTINCT {agg_alias_col}) AS {quote_identifier(alias_name)}"
+                    else:
+                        alias_suffix = agg_col_with_alias.replace('.', '_').replace('*', 'all')
+                        alias_name = f"{agg_func.lower()}_{alias_suffix}"
+                        agg_expression = f"{agg_func}({agg_alias_col}) AS {quote_identifier(alias_name)}"
+                    
+                    aggregate_columns.append(agg_expression)
+            else:
+                # 古いデータ構造（互換性のため）
+                group_by_columns.append(to_alias_column(condition['column'], alias_map))
+        
+        # GROUP BYとSELECT句の修正
+        if group_by_columns or aggregate_columns:
+            # GROUP BY句がある場合、SELECT句を再構成
+            sql_parts['select'] = f"SELECT {', '.join(group_by_columns + aggregate_columns)}"
+        
+        if group_by_columns:
+            sql_parts['group_by'] = f"GROUP BY {', '.join(group_by_columns)}"
+    
+    # ORDER BY句の追加（GROUP BY対応・集計結果ソート対応）
+    # GROUP BYがある場合にソートできない通常カラムは、画面側で案内するため別途返す
+    skipped_order_columns = []
+    if config['order_by']:
+        # GROUP BYのグルーピングカラム（GROUP BYがある場合、通常カラムはこれに含まれるものだけソート可能）
+        grouping_columns = {
+            group_condition.get('group_column')
+            for group_condition in group_by_conditions
+            if group_condition.get('is_grouping_column', False)
+        }
+        order_by_clauses = []
+        for condition in config['order_by']:
+            col_with_alias = condition['column']
+            sort_type = condition.get('sort_type', '通常カラム')
+            
+            if sort_type == "集計結果":
+                # 集計結果でのソート（エイリアス名を直接使用）
+                order_by_clauses.append(f"{quote_identifier(col_with_alias)} {condition['direction']}")
+            elif group_by_conditions and col_with_alias not in grouping_columns:
+                skipped_order_columns.append(col_with_alias)
+            else:
+                order_by_clauses.append(f"{to_alias_column(col_with_alias, alias_map)} {condition['direction']}")
+        
+        if order_by_clauses:
+            sql_parts['order_by'] = f"ORDER BY {', '.join(order_by_clauses)}"
+    
+    join_query = "\n".join(filter(None, (
+        sql_parts['select'], sql_parts['from'], sql_parts['where'], sql_parts['group_by'], sql_parts['order_by']
+    )))
+    return join_query, skipped_order_columns
+
+def render_condition_list(lines: list, state_key: str, button_key_prefix: str):
+    """設定済み条件を1件1行（条件の内容＋削除ボタン）で表示する（削除ボタンは位置ではなく条件ごとのIDで識別する）"""
+    conditions = st.session_state[state_key]
+    for line, condition in zip(lines, conditions):
+        # ID導入前に追加された条件にもIDを振っておく
+        condition_id = condition.setdefault('id', uuid.uuid4().hex[:8])
+        text_col, button_col = st.columns([12, 1])
+        text_col.markdown(line)
+        if button_col.button("🗑️", key=f"{button_key_prefix}_{condition_id}"):
+            st.session_state[state_key] = [c for c in conditions if c.get('id') != condition_id]
+            st.rerun()
 
 def is_date_type(data_type: str) -> bool:
     """データ型が日付型かどうかを判定する"""
     if not data_type:
         return False
-    
     data_type_upper = data_type.upper()
-    date_types = [
-        'DATE', 'DATETIME', 'TIMESTAMP', 'TIMESTAMP_NTZ', 'TIMESTAMP_LTZ', 'TIMESTAMP_TZ',
-        'TIME', 'DATETIME_NTZ', 'DATETIME_LTZ', 'DATETIME_TZ'
-    ]
-    
-    return any(date_type in data_type_upper for date_type in date_types)
+    return any(date_type in data_type_upper for date_type in _DATE_TYPES)
 
+@lru_cache(maxsize=512)
 def is_date_like_column(col_name: str, data_type: str) -> bool:
     """カラムが日付データを含む可能性があるかを判定する（型とカラム名の両方をチェック）"""
     # まずデータ型で判定
@@ -199,65 +542,57 @@ def is_date_like_column(col_name: str, data_type: str) -> bool:
     
     # カラム名に日付を示すキーワードが含まれている場合（VARCHAR型でも日付として扱う）
     col_name_upper = col_name.upper()
-    date_keywords = [
-        'DATE', 'DT', '日付', '年月日', 'YMD', 'YYYYMMDD',
-        '_AT', 'CREATED', 'UPDATED', 'REGISTERED', 'TIMESTAMP',
-        '登録日', '更新日', '作成日', '開始日', '終了日', '取引日', '発生日'
-    ]
-    
-    return any(keyword in col_name_upper for keyword in date_keywords)
+    return any(keyword in col_name_upper for keyword in _DATE_KEYWORDS)
 
 def is_numeric_type(data_type: str) -> bool:
     """データ型が数値型かどうかを判定する"""
     if not data_type:
         return False
-    
     data_type_upper = data_type.upper()
-    numeric_types = [
-        'NUMBER', 'INT', 'INTEGER', 'BIGINT', 'SMALLINT', 'TINYINT',
-        'FLOAT', 'DOUBLE', 'DECIMAL', 'NUMERIC'
-    ]
-    
-    return any(numeric_type in data_type_upper for numeric_type in numeric_types)
+    return any(numeric_type in data_type_upper for numeric_type in _NUMERIC_TYPES)
 
 
-@st.cache_data(ttl=300, show_spinner=False)
+@st.cache_data(ttl=60, show_spinner=False)
+def _object_index(database: str) -> set:
+    """DB内の全テーブル/ビューを (スキーマ名, オブジェクト名) の集合として取得"""
+    # 列の少ないTERSE版で、DB内のテーブル/ビューを1回でまとめて取得する
+    # （失敗時は例外をそのまま送出し、空の索引をキャッシュしない。呼び出し側でDESCRIBEにフォールバックする）
+    rows = session.sql(f"SHOW TERSE OBJECTS IN DATABASE {quote_identifier(database)}").collect()
+    return {(row['schema_name'], row['name']) for row in rows}
+
 def get_table_schema(table_name: str) -> str:
     """テーブルがどのスキーマに存在するかを判定して返す"""
-    # まず選択中のスキーマを確認
-    current_schema = get_current_data_schema()
-    try:
-        quoted_table = f'"{table_name}"' if not table_name.startswith('"') else table_name
-        session.sql(f"DESCRIBE TABLE {current_schema}.{quoted_table}").collect()
-        return current_schema
-    except:
-        pass
-    # 次にapplication_db.application_schemaを確認（システムテーブル用）
-    try:
-        quoted_table = f'"{table_name}"' if not table_name.startswith('"') else table_name
-        session.sql(f"DESCRIBE TABLE {APP_DATA_SCHEMA}.{quoted_table}").collect()
-        return APP_DATA_SCHEMA
-    except:
-        pass
-    return current_schema  # デフォルトは選択中のスキーマ
+    return _resolve_table_schema(get_current_data_schema(), table_name)
 
-def is_excluded_table(table_name: str) -> bool:
-    """除外対象のテーブルかどうかを判定"""
-    if table_name in SYSTEM_TABLES:
-        return True
-    if table_name.upper().startswith(EXCLUDED_PREFIXES):
-        return True
-    return False
+@st.cache_data(ttl=300, show_spinner=False)
+def _resolve_table_schema(current_schema: str, table_name: str) -> str:
+    """選択中のスキーマ→システムテーブル用スキーマの順に、テーブルの所在を判定"""
+    # まずSHOW結果の索引で判定する（未クォートの識別子は大文字で格納されるため大文字でも確認）
+    for qualified_schema in (current_schema, APP_DATA_SCHEMA):
+        database, _, schema = qualified_schema.partition('.')
+        try:
+            index = _object_index(database)
+        except Exception:
+            # 索引が取得できないDBはDESCRIBEでの確認に任せる
+            continue
+        if (schema, table_name) in index or (schema.upper(), table_name) in index:
+            return qualified_schema
+    # 索引で見つからない場合のみDESCRIBEで確認する
+    quoted_table = f'"{table_name}"' if not table_name.startswith('"') else table_name
+    for qualified_schema in (current_schema, APP_DATA_SCHEMA):
+        try:
+            session.sql(f"DESCRIBE TABLE {qualified_schema}.{quoted_table}").collect()
+            return qualified_schema
+        except:
+            pass
+    return current_schema  # デフォルトは選択中のスキーマ
 
-def get_available_relations():
+def get_available_relations(selected_db: str, selected_schema: str):
     """選択されたスキーマからテーブルとビュー名を取得"""
     tables = []
     views = []
     
     # 選択されたDB/スキーマからテーブル/ビューを取得
-    selected_db = st.session_state.get('selected_database', '')
-    selected_schema = st.session_state.get('selected_schema', '')
-    
     if selected_db and selected_schema:
         # テーブル取得
         tables = get_available_tables_dynamic(selected_db, selected_schema)
@@ -267,8 +602,10 @@ def get_available_relations():
         st.warning("⚠️ サイドバーでデータベースとスキーマを選択してください")
     
     # ラベル付けして返す
-    labeled = [f"[TABLE] {t}" for t in tables] + [f"[VIEW] {v}" for v in views]
-    return sorted(labeled)
+    # テーブル・ビューはそれぞれソート済みで、"[TABLE]" < "[VIEW]" のため連結した時点でソート済みになる
+    labeled = [f"[TABLE] {t}" for t in tables]
+    labeled.extend(f"[VIEW] {v}" for v in views)
+    return labeled
 
 def parse_relation_label(label: str) -> str:
     """[TABLE]/[VIEW] ラベルからオブジェクト名のみ取り出す"""
@@ -277,6 +614,26 @@ def parse_relation_label(label: str) -> str:
 
 # create_adhoc_search_table関数は削除 - setup SQLで事前作成済み
 
+# 保存・更新用SQL（値はすべてバインド変数で渡し、SQL本文は毎回同一の文字列を使う）
+_ADHOC_INSERT_SQL = """
+INSERT INTO application_db.application_schema.ADHOC_SEARCH_OBJECTS (
+    object_id, object_name, description, table1_name, table2_name,
+    join_type, join_key1, join_key2, search_query, created_by, is_favorite
+) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_USER(), ?)
+"""
+_ADHOC_EXECUTION_COUNT_SQL = """
+UPDATE application_db.application_schema.ADHOC_SEARCH_OBJECTS 
+SET execution_count = execution_count + 1, 
+    last_executed = CURRENT_TIMESTAMP()
+WHERE object_id = ?
+"""
+_ADHOC_TOGGLE_FAVORITE_SQL = """
+UPDATE application_db.application_schema.ADHOC_SEARCH_OBJECTS 
+SET is_favorite = NOT is_favorite,
+    updated_at = CURRENT_TIMESTAMP()
+WHERE object_id = ?
+"""
+
 def save_adhoc_search_object(object_data: dict):
     """非定型検索オブジェクトを保存（新構成版）"""
     try:
@@ -288,12 +645,7 @@ def save_adhoc_search_object(object_data: dict):
         join_key1 = object_data.get('join_key1') or 'key1'
         join_key2 = object_data.get('join_key2') or 'key2'
         
-        session.sql("""
-        INSERT INTO application_db.application_schema.ADHOC_SEARCH_OBJECTS (
-            object_id, object_name, description, table1_name, table2_name,
-            join_type, join_key1, join_key2, search_query, created_by, is_favorite
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_USER(), ?)
-        """, params=[
+        session.sql(_ADHOC_INSERT_SQL, params=[
             object_data['object_id'],
             object_data['object_name'],
             object_data['description'],
@@ -313,12 +665,7 @@ def save_adhoc_search_object(object_data: dict):
 def update_adhoc_execution_count(object_id: str):
     """非定型検索オブジェクトの実行回数を更新する"""
     try:
-        session.sql("""
-        UPDATE application_db.application_schema.ADHOC_SEARCH_OBJECTS 
-        SET execution_count = execution_count + 1, 
-            last_executed = CURRENT_TIMESTAMP()
-        WHERE object_id = ?
-        """, params=[object_id]).collect()
+        session.sql(_ADHOC_EXECUTION_COUNT_SQL, params=[object_id]).collect()
         return True
     except Exception as e:
         st.error(f"実行回数更新エラー: {str(e)}")
@@ -327,12 +674,7 @@ def update_adhoc_execution_count(object_id: str):
 def toggle_adhoc_favorite(object_id: str):
     """お気に入り状態を切り替える"""
     try:
-        session.sql("""
-        UPDATE application_db.application_schema.ADHOC_SEARCH_OBJECTS 
-        SET is_favorite = NOT is_favorite,
-            updated_at = CURRENT_TIMESTAMP()
-        WHERE object_id = ?
-        """, params=[object_id]).collect()
+        session.sql(_ADHOC_TOGGLE_FAVORITE_SQL, params=[object_id]).collect()
         return True
     except Exception as e:
         st.error(f"お気に入り更新エラー: {str(e)}")
@@ -354,15 +696,20 @@ def save_result_as_work_table(df: pd.DataFrame, table_name: str):
         print(f"[DEBUG] 保存対象テーブル名: {table_name}")
         print(f"[DEBUG] データフレームサイズ: {len(df)} 行, {len(df.columns)} 列")
         
-        # Snowpark DataFrameに変換してSnowflakeに保存
-        from snowflake.snowpark import Session
-        snowpark_df = session.create_dataframe(df)
-        
-        # テーブル名を明示的に指定して保存
-        snowpark_df.write.mode("overwrite").save_as_table(table_name)
+        # write_pandas（Parquet の PUT + COPY INTO）で一括ロードする
+        # 非クォート識別子として扱われていた従来の挙動に合わせて大文字化する
+        *qualifier, table_only = [part.strip('"').upper() for part in table_name.split('.')]
+        qualifier = [None] * (2 - len(qualifier)) + qualifier
+        session.write_pandas(
+            df, table_only,
+            database=qualifier[0], schema=qualifier[1],
+            auto_create_table=True, overwrite=True,
+            quote_identifiers=True, use_logical_type=True,
+            chunk_size=100_000
+        )
         
         # 保存成功（詳細なメッセージは呼び出し元で表示）
-        return True, "保存完了"
+        return True, f"{len(df)} 行保存完了"
             
     except Exception as e:
         print(f"[ERROR] 保存エラー: {str(e)}")
@@ -371,8 +718,8 @@ def save_result_as_work_table(df: pd.DataFrame, table_name: str):
 def create_snowflake_task_for_adhoc(task_name: str, schedule: str, search_query: str, work_table_name: str):
     """非定型検索用のSnowflakeタスクを作成（1_standard_search.pyを参考に実装）"""
     try:
-        # タスク名をクォートして特殊文字に対応
-        quoted_task_name = f'"{task_name}"'
+        # タスク名をクォートして特殊文字に対応（一覧取得と同じアプリ用スキーマに作成する）
+        quoted_task_name = f'{APP_DATA_SCHEMA}."{task_name}"'
         quoted_work_table = quote_identifier(work_table_name)
         
         # 検索クエリをエスケープ
@@ -385,10 +732,10 @@ def create_snowflake_task_for_adhoc(task_name: str, schedule: str, search_query:
         AS
         CREATE OR REPLACE TABLE {quoted_work_table} AS ({escaped_query})
         """
-        session.sql(create_task_sql).collect()
-        
-        # タスクを有効化
-        session.sql(f"ALTER TASK {quoted_task_name} RESUME").collect()
+        # タスク作成と有効化を1回の複数ステートメント送信にまとめる
+        session.sql(
+            f"{create_task_sql.strip()};\nALTER TASK {quoted_task_name} RESUME"
+        ).collect(statement_params={"MULTI_STATEMENT_COUNT": 2})
         
         return True, "タスクを作成し、有効化しました"
     except Exception as e:
@@ -397,71 +744,99 @@ def create_snowflake_task_for_adhoc(task_name: str, schedule: str, search_query:
 def get_scheduled_tasks_adhoc():
     """登録済みのタスク一覧を取得（非定型検索用）"""
     try:
-        result = session.sql("SHOW TASKS").collect()
-        tasks = []
-        for row in result:
-            task_info = row.as_dict()
-            # 非定型検索関連のタスクのみフィルター
-            if task_info.get('name', '').startswith('adhoc_'):
-                tasks.append(task_info)
-        return tasks
+        # 非定型検索関連のタスクのみをアプリ用スキーマ内でサーバー側で絞り込む（'_' はワイルドカードなのでエスケープ）
+        result = session.sql(rf"SHOW TASKS LIKE 'adhoc\\_%' IN SCHEMA {APP_DATA_SCHEMA}").collect()
+        # LIKEは大文字小文字を区別しないため、タスク名の接頭辞はPython側で改めて確認する
+        return [row.as_dict() for row in result if row['name'].startswith('adhoc_')]
     except Exception as e:
         st.error(f"タスク一覧取得エラー: {str(e)}")
         return []
 
-def suspend_task_adhoc(task_name: str):
-    """タスクを一時停止"""
+def bulk_task_action(task_names: list, action: str):
+    """複数タスクへのALTER TASKを1回の複数ステートメント送信で実行"""
+    if action not in ("SUSPEND", "RESUME"):
+        return False, f"不正な操作です: {action}"
+    if not task_names:
+        return True, "対象タスクがありません"
     try:
-        quoted_task_name = f'"{task_name}"'
-        session.sql(f"ALTER TASK {quoted_task_name} SUSPEND").collect()
-        return True, "タスクを一時停止しました"
+        statements = ";\n".join(
+            f'ALTER TASK {APP_DATA_SCHEMA}."{t.replace(chr(34), chr(34) * 2)}" {action}' for t in task_names
+        )
+        session.sql(statements).collect(
+            statement_params={"MULTI_STATEMENT_COUNT": len(task_names)}
+        )
+        return True, f"{len(task_names)}件のタスクを更新しました"
     except Exception as e:
         return False, str(e)
 
+def suspend_task_adhoc(task_name: str):
+    """タスクを一時停止"""
+    success, msg = bulk_task_action([task_name], "SUSPEND")
+    return (True, "タスクを一時停止しました") if success else (False, msg)
+
 def resume_task_adhoc(task_name: str):
     """タスクを再開"""
+    success, msg = bulk_task_action([task_name], "RESUME")
+    return (True, "タスクを再開しました") if success else (False, msg)
+
+def fetch_dataframe(query: str) -> pd.DataFrame:
+    """クエリ結果をArrowのバッチ単位で取得してDataFrameに変換する（pyarrowがない場合はto_pandasで取得）"""
     try:
-        quoted_task_name = f'"{task_name}"'
-        session.sql(f"ALTER TASK {quoted_task_name} RESUME").collect()
-        return True, "タスクを再開しました"
-    except Exception as e:
-        return False, str(e)
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return session.sql(query).to_pandas()
+
+    cur = session.connection.cursor()
+    try:
+        cur.execute(query)
+        # 結果全体を1つのArrowテーブルにせず、バッチ単位でDataFrame化してメモリのピークを抑える
+        frames = [
+            batch.to_pandas(split_blocks=True, self_destruct=True)
+            for batch in cur.fetch_arrow_batches()
+        ]
+        if not frames:
+            # 0件の場合はバッチが返らないため、カラム名のみの空DataFrameを返す
+            return pd.DataFrame(columns=[c[0] for c in cur.description])
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=True)
+    finally:
+        cur.close()
 
 def execute_query(search_query: str, limit_rows: int = 1000):
     """クエリを実行し、結果をセッション状態に保存する"""
     try:
         final_query = search_query.strip()
+        # デバッグ情報はサイドバーのデバッグ表示がONの時だけ出力する
+        debug = st.session_state.get('adhoc_debug', False)
         
-        # LIMIT句がない場合のみ追加（デバッグ情報付き）
-        if "LIMIT" not in final_query.upper():
+        # LIMIT句がない場合のみ追加
+        if not _LIMIT_RE.search(final_query):
             final_query = f"{final_query} LIMIT {int(limit_rows)}"
-            st.info(f"🔍 LIMIT句を追加しました: {limit_rows}行")
-        else:
+            if debug:
+                st.info(f"🔍 LIMIT句を追加しました: {limit_rows}行")
+        elif debug:
             st.info(f"🔍 既存のLIMIT句を使用します")
         
         # デバッグ用: 最終的なクエリを表示
-        st.code(final_query, language="sql")
+        if debug:
+            st.code(final_query, language="sql")
         
         with st.spinner("検索実行中..."):
-            # 件数チェック（LIMIT句を考慮）
-            try:
-                test_query = f"SELECT COUNT(*) FROM ({final_query.replace(f'LIMIT {limit_rows}', '')})"
-                row_count = session.sql(test_query).collect()[0][0]
-                
-                if row_count > 5000:
-                    st.warning(f"検索結果が5,000行を超えています。表示に時間がかかる場合があります。総件数: {row_count} 行")
-                elif row_count == 0:
-                    st.warning("検索条件に該当するデータがありません。")
-                    return
-                else:
-                    st.info(f"📊 総件数: {row_count} 行、制限: {limit_rows} 行")
-            except Exception as count_error:
-                st.warning(f"件数チェックエラー: {str(count_error)}")
-
-            # データ取得実行
-            df_result = session.sql(final_query).to_pandas()
+            # データ取得実行（件数は取得結果から判定し、COUNT(*)による二重実行は行わない）
+            df_result = fetch_dataframe(final_query)
+            row_count = len(df_result)
+            
+            if row_count == 0:
+                st.warning("検索条件に該当するデータがありません。")
+                return
+            if row_count > 5000:
+                st.warning(f"検索結果が5,000行を超えています。表示に時間がかかる場合があります。取得件数: {row_count} 行")
+            elif row_count >= limit_rows:
+                st.info(f"📊 制限 {limit_rows} 行に達しました。条件に該当するデータがさらに存在する可能性があります。")
+            
             st.session_state.search_result_df = df_result
-            st.success(f"✅ 実際の取得件数: {len(df_result)} 行。下部の『📄 出力結果』に表示しました。")
+            st.success(f"✅ 実際の取得件数: {row_count} 行。下部の『📄 出力結果』に表示しました。")
 
     except Exception as e:
         st.error(f"検索エラー: {str(e)}")
@@ -513,11 +888,20 @@ if databases:
 else:
     st.sidebar.warning("データベースが見つかりません")
 
-# 選択中の情報を表示
-if st.session_state.selected_database and st.session_state.selected_schema:
-    tables = get_available_tables_dynamic(st.session_state.selected_database, st.session_state.selected_schema)
-    views = get_available_views_dynamic(st.session_state.selected_database, st.session_state.selected_schema)
-    st.sidebar.info(f"📊 テーブル: {len(tables)}個 / ビュー: {len(views)}個")
+# 選択が確定したDB/スキーマ（以降はセッション状態を都度参照せずこの値を使う）
+active_database = st.session_state.selected_database
+active_schema = st.session_state.selected_schema
+
+# 選択中の情報を表示（件数は要求された時だけ取得する）
+# ※ st.expander内のコードは閉じていても実行されるため、チェックボックスで取得自体を制御する
+if active_database and active_schema:
+    if st.sidebar.checkbox("📊 オブジェクト統計を表示", value=False, key="adhoc_show_object_stats"):
+        tables = get_available_tables_dynamic(active_database, active_schema)
+        views = get_available_views_dynamic(active_database, active_schema)
+        st.sidebar.info(f"📊 テーブル: {len(tables)}個 / ビュー: {len(views)}個")
+
+# 開発用: 検索実行時のLIMIT付与状況や最終クエリを表示する
+st.sidebar.checkbox("🐞 デバッグ表示", value=False, key="adhoc_debug")
 
 st.sidebar.markdown("---")
 
@@ -545,7 +929,7 @@ colL, colR = st.columns([1, 1])
 # テーブル1
 with colL:
     st.markdown("#### 📋 テーブル1（メインテーブル）")
-    available_relations = get_available_relations()
+    available_relations = get_available_relations(active_database, active_schema)
     
     if available_relations:
         selected_relation1 = st.selectbox("テーブル1を選択", [""] + available_relations, key="table1_selector")
@@ -554,20 +938,9 @@ with colL:
             
             if st.session_state.selected_table1:
                 st.markdown("##### 🔍 テーブル1 カラム情報")
-                basic_cols1 = get_table_columns(st.session_state.selected_table1)
-                cols1_info = [{'name': c['name'], 'type': c['type']} for c in basic_cols1]
+                df1 = get_column_display_df(st.session_state.selected_table1)
                 
-                if cols1_info:
-                    display_data1 = []
-                    for c in cols1_info:
-                        display_row = {
-                            'カラム名': c['name'],
-                            'データ型': c['type']
-                        }
-                        display_data1.append(display_row)
-                    
-                    df1 = pd.DataFrame(display_data1)
-                    
+                if not df1.empty:
                     column_config1 = {
                         "カラム名": st.column_config.TextColumn("カラム名", width="medium"),
                         "データ型": st.column_config.TextColumn("データ型", width="small")
@@ -590,20 +963,9 @@ with colR:
             
             if st.session_state.selected_table2:
                 st.markdown("##### 🔍 テーブル2 カラム情報")
-                basic_cols = get_table_columns(st.session_state.selected_table2)
-                cols_info = [{'name': c['name'], 'type': c['type']} for c in basic_cols]
+                df = get_column_display_df(st.session_state.selected_table2)
                 
-                if cols_info:
-                    display_data = []
-                    for c in cols_info:
-                        display_row = {
-                            'カラム名': c['name'],
-                            'データ型': c['type']
-                        }
-                        display_data.append(display_row)
-                    
-                    df = pd.DataFrame(display_data)
-                    
+                if not df.empty:
                     column_config = {
                         "カラム名": st.column_config.TextColumn("カラム名", width="medium"),
                         "データ型": st.column_config.TextColumn("データ型", width="small")
@@ -780,96 +1142,115 @@ else:
 st.markdown("---")
 st.markdown("### 📋 STEP 3: 出力カラム選択")
 
+# STEP 3・4で使うテーブル毎のカラム情報（再実行毎に1テーブル1回だけ取得して使い回す）
+table1_columns = get_table_columns(st.session_state.selected_table1) if st.session_state.selected_table1 else []
+table2_columns = get_table_columns(st.session_state.selected_table2) if st.session_state.selected_table2 else []
+table3_columns = (get_table_columns(st.session_state.selected_table3)
+                  if st.session_state.enable_3table_join and st.session_state.selected_table3 else [])
+
 # 2テーブルまたは3テーブル結合でカラム選択可能な場合
 if ((not st.session_state.enable_3table_join and st.session_state.selected_table1 and st.session_state.selected_table2) or
     (st.session_state.enable_3table_join and st.session_state.selected_table1 and st.session_state.selected_table2 and st.session_state.selected_table3)):
     
-    # 全カラム情報を収集
-    all_columns = []
-    
-    # テーブル1のカラム
-    cols1 = get_table_columns(st.session_state.selected_table1)
-    for col in cols1:
-        all_columns.append({
-            'display_name': f"[T1] {col['name']}",
-            'sql_name': f"t1.{quote_identifier(col['name'])}",
-            'original_name': col['name'],
-            'table': 'T1',
-            'type': col['type']
-        })
+    # 結合キーを特定（業務的に不要なため除外）
+    join_key_candidates = (st.session_state.join_key1, st.session_state.join_key2)
+    if st.session_state.enable_3table_join:
+        join_key_candidates += (st.session_state.join_key3, st.session_state.join_key2_for_join2)
+    join_keys_to_exclude = {key for key in join_key_candidates if key}
+    
+    # カラム一覧・重複判定はテーブル/結合キーの選択が変わった時だけ作り直す（チェック操作毎の再計算を避ける）
+    column_cache_key = (
+        get_current_data_schema(),
+        st.session_state.selected_table1,
+        st.session_state.selected_table2,
+        st.session_state.selected_table3 if st.session_state.enable_3table_join else "",
+        frozenset(join_keys_to_exclude),
+        # メタデータの再取得でカラム構成（名前・型）が変わった場合も作り直す
+        column_fingerprint(table1_columns),
+        column_fingerprint(table2_columns),
+        column_fingerprint(table3_columns),
+    )
+    if st.session_state.get('_adhoc_column_cache_key') != column_cache_key:
+        # 行構成が変わるため、行番号で保持されているカラム選択エディタの編集内容を破棄する
+        # （残すと前のテーブルでの編集が別のカラムの行に適用される）
+        st.session_state.pop(ADHOC_COLUMN_EDITOR_KEY, None)
+        
+        # 全カラム情報を収集
+        all_columns = []
     
-    # テーブル2のカラム
-    cols2 = get_table_columns(st.session_state.selected_table2)
-    for col in cols2:
-        all_columns.append({
-            'display_name': f"[T2] {col['name']}",
-            'sql_name': f"t2.{quote_identifier(col['name'])}",
-            'original_name': col['name'],
-            'table': 'T2',
-            'type': col['type']
-        })
+        # テーブル1のカラム
+        cols1 = table1_columns
+        for col in cols1:
+            all_columns.append({
+                'display_name': f"[T1] {col['name']}",
+                'sql_name': f"t1.{quote_identifier(col['name'])}",
+                'original_name': col['name'],
+                'table': 'T1',
+                'type': col['type']
+            })
     
-    # テーブル3のカラム（3テーブルモードの場合）
-    if st.session_state.enable_3table_join and st.session_state.selected_table3:
-        cols3 = get_table_columns(st.session_state.selected_table3)
-        for col in cols3:
+        # テーブル2のカラム
+        cols2 = table2_columns
+        for col in cols2:
             all_columns.append({
-                'display_name': f"[T3] {col['name']}",
-                'sql_name': f"t3.{quote_identifier(col['name'])}",
+                'display_name': f"[T2] {col['name']}",
+                'sql_name': f"t2.{quote_identifier(col['name'])}",
                 'original_name': col['name'],
-                'table': 'T3',
+                'table': 'T2',
                 'type': col['type']
             })
     
-    # 重複カラム名への対応
-    table1_col_names = {c['name'] for c in cols1}
-    table2_col_names = {c['name'] for c in cols2}
-    duplicate_cols = table1_col_names & table2_col_names
+        # テーブル3のカラム（3テーブルモードの場合）
+        if st.session_state.enable_3table_join and st.session_state.selected_table3:
+            cols3 = table3_columns
+            for col in cols3:
+                all_columns.append({
+                    'display_name': f"[T3] {col['name']}",
+                    'sql_name': f"t3.{quote_identifier(col['name'])}",
+                    'original_name': col['name'],
+                    'table': 'T3',
+                    'type': col['type']
+                })
     
-    if st.session_state.enable_3table_join and st.session_state.selected_table3:
-        cols3 = get_table_columns(st.session_state.selected_table3)
-        table3_col_names = {c['name'] for c in cols3}
-        duplicate_cols.update(table1_col_names & table3_col_names)
-        duplicate_cols.update(table2_col_names & table3_col_names)
+        # 重複カラム名への対応（2テーブル／3テーブル共通で、全カラムを1回走査して複数テーブルにある名前を数える）
+        name_counts = Counter(col_info['original_name'] for col_info in all_columns)
+        duplicate_cols = {name for name, count in name_counts.items() if count > 1}
     
-    # 結合キーを特定（業務的に不要なため除外）
-    join_keys_to_exclude = set()
-    if st.session_state.join_key1:
-        join_keys_to_exclude.add(st.session_state.join_key1)
-    if st.session_state.join_key2:
-        join_keys_to_exclude.add(st.session_state.join_key2)
-    if st.session_state.enable_3table_join and st.session_state.join_key3:
-        join_keys_to_exclude.add(st.session_state.join_key3)
-    if st.session_state.enable_3table_join and st.session_state.join_key2_for_join2:
-        join_keys_to_exclude.add(st.session_state.join_key2_for_join2)
-    
-    # 重複カラムから結合キーを除外（結合キーは重複でも問題ない）
-    duplicate_cols_excluding_join_keys = duplicate_cols - join_keys_to_exclude
-    
-    # 結合キー除外後のカラムのみを処理
-    processed_columns = []
-    excluded_count = 0
-    
-    for col_info in all_columns:
-        # 結合キーは除外（業務観点で不要）
-        if col_info['original_name'] in join_keys_to_exclude:
-            excluded_count += 1
-            continue
+        # 重複カラムから結合キーを除外（結合キーは重複でも問題ない）
+        duplicate_cols_excluding_join_keys = duplicate_cols - join_keys_to_exclude
+    
+        # 結合キー除外後のカラムのみを処理
+        processed_columns = []
+    
+        for col_info in all_columns:
+            # 結合キーは除外（業務観点で不要）
+            if col_info['original_name'] in join_keys_to_exclude:
+                continue
+        
+            # 重複カラムは別名で処理（結合キー除外後）
+            if col_info['original_name'] in duplicate_cols_excluding_join_keys:
+                alias_name = f"{col_info['table'].lower()}_{col_info['original_name']}"
+                col_info['sql_name'] = f"{col_info['sql_name']} AS {quote_identifier(alias_name)}"
+                col_info['display_name'] = f"[{col_info['table']}] {col_info['original_name']} (→{alias_name})"
         
-        # 重複カラムは別名で処理（結合キー除外後）
-        if col_info['original_name'] in duplicate_cols_excluding_join_keys:
-            alias_name = f"{col_info['table'].lower()}_{col_info['original_name']}"
-            col_info['sql_name'] = f"{col_info['sql_name']} AS {quote_identifier(alias_name)}"
-            col_info['display_name'] = f"[{col_info['table']}] {col_info['original_name']} (→{alias_name})"
+            processed_columns.append(col_info)
         
-        processed_columns.append(col_info)
+        st.session_state._adhoc_column_cache_key = column_cache_key
+        st.session_state._adhoc_processed_columns = processed_columns
+        # SQL表現→（テーブル別名, 元のカラム名）。STEP 3〜5で選択カラムを文字列解析せずに引けるようにする
+        st.session_state._adhoc_selected_name_lookup = {
+            col['sql_name']: (col['table'].lower(), col['original_name']) for col in processed_columns
+        }
+        st.session_state._adhoc_dup_cols_excl = duplicate_cols_excluding_join_keys
+    
+    processed_columns = st.session_state._adhoc_processed_columns
+    duplicate_cols_excluding_join_keys = st.session_state._adhoc_dup_cols_excl
     
     # 除外したキー情報を表示
-    if excluded_count > 0:
-        st.info(f"🔗 結合キー {excluded_count}個を自動除外しました（業務観点で不要なため）")
+    if join_keys_to_exclude:
+        st.info(f"🔗 結合キー {len(join_keys_to_exclude)}個を自動除外しました（業務観点で不要なため）")
         with st.expander("🔍 除外された結合キー", expanded=False):
-            for key in sorted(join_keys_to_exclude):
-                st.write(f"- `{key}`")
+            st.markdown("\n".join(f"- `{key}`" for key in sorted(join_keys_to_exclude)))
     
     # カラム選択UI
     col_select1, col_select2 = st.columns([1, 1])
@@ -877,14 +1258,19 @@ if ((not st.session_state.enable_3table_join and st.session_state.selected_table
     with col_select1:
         if st.button("✅ 全選択", key="select_all_adhoc_cols"):
             st.session_state.adhoc_selected_columns = {col['sql_name'] for col in processed_columns}
-            st.rerun()
+            # エディタ側に残った編集内容で選択が上書きされないようリセットする
+            st.session_state.pop(ADHOC_COLUMN_EDITOR_KEY, None)
         
         if st.button("🧹 全解除", key="clear_all_adhoc_cols"):
             st.session_state.adhoc_selected_columns = set()
-            st.rerun()
+            st.session_state.pop(ADHOC_COLUMN_EDITOR_KEY, None)
     
     with col_select2:
         filter_text = st.text_input("カラム検索（部分一致）", key="adhoc_col_filter")
+        # 絞り込みが変わると行の並びが変わるため、行番号で保持されている編集内容をこの時だけリセットする
+        if st.session_state.get('_adhoc_col_filter_prev') != filter_text:
+            st.session_state.pop(ADHOC_COLUMN_EDITOR_KEY, None)
+            st.session_state._adhoc_col_filter_prev = filter_text
     
     # カラム一覧表示（選択機能付き）
     if filter_text:
@@ -894,17 +1280,14 @@ if ((not st.session_state.enable_3table_join and st.session_state.selected_table
     
     if filtered_columns:
         # リスト形式UIで一度のクリックで確実に選択できるように改善
-        display_data = []
-        for col in filtered_columns:
-            is_selected = col['sql_name'] in st.session_state.adhoc_selected_columns
-            display_data.append({
-                '選択': is_selected,
-                'カラム名': col['display_name'],
-                'データ型': col['type'],
-                'テーブル': col['table']
-            })
-        
-        df_cols = pd.DataFrame(display_data)
+        # 行毎のdictではなく列毎のリストから、型を明示してDataFrameを作成する（型推論を行わない）
+        selected_now = st.session_state.adhoc_selected_columns
+        df_cols = pd.DataFrame({
+            '選択': pd.Series([col['sql_name'] in selected_now for col in filtered_columns], dtype='bool'),
+            'カラム名': pd.Series([col['display_name'] for col in filtered_columns], dtype='string'),
+            'データ型': pd.Series([col['type'] for col in filtered_columns], dtype='string'),
+            'テーブル': pd.Series([col['table'] for col in filtered_columns], dtype='string')
+        })
         
         column_config = {
             "選択": st.column_config.CheckboxColumn("選択", help="出力するカラムを選択", default=False),
@@ -913,32 +1296,25 @@ if ((not st.session_state.enable_3table_join and st.session_state.selected_table
             "テーブル": st.column_config.TextColumn("テーブル", width="small")
         }
         
-        # キーを動的に生成して状態管理を改善
-        editor_key = f"adhoc_column_selection_editor_{len(filtered_columns)}"
-        
         edited_df = st.data_editor(
             df_cols,
             column_config=column_config,
             hide_index=True,
             use_container_width=True,
-            key=editor_key,
+            key=ADHOC_COLUMN_EDITOR_KEY,
             disabled=["カラム名", "データ型", "テーブル"]  # 選択以外は編集不可
         )
         
         # 編集結果を即座にセッション状態に反映
-        new_selected_columns = set()
-        for idx, row in edited_df.iterrows():
-            if row['選択']:
-                # 対応するカラムのsql_nameを取得
-                for col in filtered_columns:
-                    if col['display_name'] == row['カラム名']:
-                        new_selected_columns.add(col['sql_name'])
-                        break
+        # 表示名→sql_nameの辞書を引き、選択行のカラム名をまとめて変換する
+        display_to_sql = {col['display_name']: col['sql_name'] for col in filtered_columns}
+        selected_mask = edited_df['選択'].fillna(False).astype(bool)
+        new_selected_columns = set(edited_df.loc[selected_mask, 'カラム名'].map(display_to_sql).dropna())
         
         # セッション状態を更新（変更があった場合のみ）
+        # ※ 以降の表示はこの実行内で更新後の状態を参照するため、st.rerun()による再実行は不要
         if new_selected_columns != st.session_state.adhoc_selected_columns:
             st.session_state.adhoc_selected_columns = new_selected_columns
-            st.rerun()  # 状態変更を即座に反映
         
         # 選択状況の表示
         if st.session_state.adhoc_selected_columns:
@@ -946,56 +1322,43 @@ if ((not st.session_state.enable_3table_join and st.session_state.selected_table
             
             # 選択されたカラムの詳細表示（確認用）
             with st.expander("🔍 選択されたカラム一覧", expanded=False):
-                selected_details = []
-                for col in filtered_columns:
-                    if col['sql_name'] in st.session_state.adhoc_selected_columns:
-                        selected_details.append({
-                            'カラム名': col['display_name'],
-                            'データ型': col['type'],
-                            'テーブル': col['table']
-                        })
+                # 件数が少ないため、グリッド部品ではなくMarkdownのリスト1つで表示する
+                selected_details = [
+                    f"- **{col['display_name']}** ({col['type']})"
+                    for col in filtered_columns
+                    if col['sql_name'] in st.session_state.adhoc_selected_columns
+                ]
                 
                 if selected_details:
-                    df_selected = pd.DataFrame(selected_details)
-                    st.dataframe(df_selected, use_container_width=True, hide_index=True)
+                    st.markdown("\n".join(selected_details))
         else:
             st.info("出力するカラムを選択してください")
     
     # 選択されたカラムに基づく重複カラム警告
     if st.session_state.adhoc_selected_columns:
         # 選択されたカラムから重複を検出
-        selected_col_names_t1 = set()
-        selected_col_names_t2 = set()
-        
-        for selected_col in st.session_state.adhoc_selected_columns:
-            if selected_col.startswith('t1.'):
-                col_part = selected_col[3:]  # "t1." を除去
-                if ' AS ' in col_part:
-                    col_part = col_part.split(' AS ')[0]
-                col_name = col_part.strip('"')
-                selected_col_names_t1.add(col_name)
-            elif selected_col.startswith('t2.'):
-                col_part = selected_col[3:]  # "t2." を除去
-                if ' AS ' in col_part:
-                    col_part = col_part.split(' AS ')[0]
-                col_name = col_part.strip('"')
-                selected_col_names_t2.add(col_name)
+        selected_col_names = split_selected_columns(frozenset(st.session_state.adhoc_selected_columns))
         
         # 選択されたカラム間での重複をチェック
-        selected_duplicate_cols = selected_col_names_t1 & selected_col_names_t2
+        selected_duplicate_cols = selected_col_names['t1'] & selected_col_names['t2']
         
         if selected_duplicate_cols:
             st.warning(f"⚠️ 選択されたカラムで重複検出: {len(selected_duplicate_cols)}個のカラムに別名が付与されます。")
             with st.expander("🔍 重複カラム詳細", expanded=False):
-                for dup_col in sorted(selected_duplicate_cols):
-                    st.write(f"- `{dup_col}` → `t1_{dup_col}` (テーブル1), `t2_{dup_col}` (テーブル2)")
+                # 折りたたみ時も本体は実行されるため、要素毎のst.writeではなく1回のMarkdownで出力する
+                st.markdown("\n".join(
+                    f"- `{dup_col}` → `t1_{dup_col}` (テーブル1), `t2_{dup_col}` (テーブル2)"
+                    for dup_col in sorted(selected_duplicate_cols)
+                ))
     else:
         # カラム未選択の場合は全カラムでの重複警告（結合キー除外後）
         if duplicate_cols_excluding_join_keys:
             st.warning(f"⚠️ 重複カラム検出: {len(duplicate_cols_excluding_join_keys)}個のカラム（結合キー除外後）に別名が付与されます。")
             with st.expander("🔍 重複カラム詳細", expanded=False):
-                for dup_col in sorted(duplicate_cols_excluding_join_keys):
-                    st.write(f"- `{dup_col}` → 各テーブル毎に別名付与")
+                st.markdown("\n".join(
+                    f"- `{dup_col}` → 各テーブル毎に別名付与"
+                    for dup_col in sorted(duplicate_cols_excluding_join_keys)
+                ))
 
 else:
     st.info("🔸 テーブル選択と結合条件を設定するとカラム選択が可能になります")
@@ -1007,84 +1370,33 @@ st.markdown("---")
 st.markdown("### ⚙️ STEP 4: WHERE条件・ソート・GROUP BY設定")
 
 if st.session_state.selected_table1 and st.session_state.selected_table2:
-    # STEP 3で選択されたカラムがある場合はそれを基に絞り込み
-    if st.session_state.adhoc_selected_columns:
-        # 選択されたカラムから利用可能なカラム情報を構築
-        all_columns = []
-        
-        # テーブル1のカラム
-        table1_cols = get_table_columns(st.session_state.selected_table1)
-        for col in table1_cols:
-            # 選択されたカラムに含まれているかチェック
-            t1_sql_name = f"t1.{quote_identifier(col['name'])}"
-            if any(t1_sql_name in selected_col for selected_col in st.session_state.adhoc_selected_columns):
-                all_columns.append({
-                    'name': col['name'],
-                    'type': col['type'],
-                    'table': st.session_state.selected_table1,
-                    'qualified_name': f"{st.session_state.selected_table1}.{col['name']}"
-                })
-        
-        # テーブル2のカラム
-        table2_cols = get_table_columns(st.session_state.selected_table2)
-        for col in table2_cols:
-            # 選択されたカラムに含まれているかチェック
-            t2_sql_name = f"t2.{quote_identifier(col['name'])}"
-            if any(t2_sql_name in selected_col for selected_col in st.session_state.adhoc_selected_columns):
-                all_columns.append({
-                    'name': col['name'],
-                    'type': col['type'],
-                    'table': st.session_state.selected_table2,
-                    'qualified_name': f"{st.session_state.selected_table2}.{col['name']}"
-                })
-        
-        # テーブル3のカラム（3テーブル結合の場合）
-        if st.session_state.enable_3table_join and st.session_state.selected_table3:
-            table3_cols = get_table_columns(st.session_state.selected_table3)
-            for col in table3_cols:
-                # 選択されたカラムに含まれているかチェック
-                t3_sql_name = f"t3.{quote_identifier(col['name'])}"
-                if any(t3_sql_name in selected_col for selected_col in st.session_state.adhoc_selected_columns):
-                    all_columns.append({
-                        'name': col['name'],
-                        'type': col['type'],
-                        'table': st.session_state.selected_table3,
-                        'qualified_name': f"{st.session_state.selected_table3}.{col['name']}"
-                    })
-    else:
-        # カラム未選択の場合は全カラムを表示（従来通り）
-        all_columns = []
-        
-        # テーブル1のカラム
-        table1_cols = get_table_columns(st.session_state.selected_table1)
-        for col in table1_cols:
-            all_columns.append({
-                'name': col['name'],
-                'type': col['type'],
-                'table': st.session_state.selected_table1,
-                'qualified_name': f"{st.session_state.selected_table1}.{col['name']}"
-            })
-        
-        # テーブル2のカラム
-        table2_cols = get_table_columns(st.session_state.selected_table2)
-        for col in table2_cols:
-            all_columns.append({
-                'name': col['name'],
-                'type': col['type'],
-                'table': st.session_state.selected_table2,
-                'qualified_name': f"{st.session_state.selected_table2}.{col['name']}"
-            })
-        
-        # テーブル3のカラム（3テーブル結合の場合）
-        if st.session_state.enable_3table_join and st.session_state.selected_table3:
-            table3_cols = get_table_columns(st.session_state.selected_table3)
-            for col in table3_cols:
-                all_columns.append({
-                    'name': col['name'],
-                    'type': col['type'],
-                    'table': st.session_state.selected_table3,
-                    'qualified_name': f"{st.session_state.selected_table3}.{col['name']}"
-                })
+    # 条件設定用のカラム一覧（STEP 3で選択されたカラムがある場合はそれを基に絞り込み）
+    # テーブル・カラム選択が変わった時だけ作り直し、それ以外の再実行ではセッション状態から再利用する
+    condition_tables = [
+        ('t1', st.session_state.selected_table1, table1_columns),
+        ('t2', st.session_state.selected_table2, table2_columns),
+    ]
+    if st.session_state.enable_3table_join and st.session_state.selected_table3:
+        condition_tables.append(('t3', st.session_state.selected_table3, table3_columns))
+    condition_cache_key = (
+        get_current_data_schema(),
+        tuple((alias, table_name, column_fingerprint(columns)) for alias, table_name, columns in condition_tables),
+        frozenset(st.session_state.adhoc_selected_columns),
+    )
+    if st.session_state.get('_adhoc_condition_cache_key') != condition_cache_key:
+        st.session_state._adhoc_condition_columns = build_condition_columns(
+            condition_tables,
+            split_selected_columns(condition_cache_key[2]) if st.session_state.adhoc_selected_columns else None
+        )
+        st.session_state._adhoc_condition_cache_key = condition_cache_key
+    all_columns = st.session_state._adhoc_condition_columns
+    
+    # 各selectboxで使う「テーブル.カラム (型)」形式の選択肢（再実行毎に1回だけ作成して使い回す）
+    column_option_labels = [f"{col['qualified_name']} ({col['type']})" for col in all_columns]
+    column_options_all = [""] + column_option_labels
+    numeric_column_options = [""] + [
+        label for col, label in zip(all_columns, column_option_labels) if col['is_numeric']
+    ]
     
     col_left, col_right = st.columns(2)
     
@@ -1093,44 +1405,43 @@ if st.session_state.selected_table1 and st.session_state.selected_table2:
         st.markdown("#### 🔍 WHERE条件")
         
         # 既存の条件の表示
+        where_lines = []
         for i, condition in enumerate(st.session_state.adhoc_where_conditions_list):
             op = "WHERE" if i == 0 else condition['logic_op']
             quoted_col = quote_identifier(condition['column'])
-            st.write(f"**{op.upper()}** `{quoted_col}` {condition['operator']} `'{condition['value']}'`")
-            if st.button("🗑️", key=f"del_where_cond_{i}"):
-                del st.session_state.adhoc_where_conditions_list[i]
-                st.rerun()
+            where_lines.append(f"{i + 1}. **{op.upper()}** `{quoted_col}` {condition['operator']} `'{condition['value']}'`")
+        render_condition_list(where_lines, 'adhoc_where_conditions_list', "del_where_cond")
 
         # 新しい条件の追加フォーム
+        # 入力中の再実行を避けるため、フォームにまとめて「追加」押下時のみ反映する
         with st.expander("➕ WHERE条件を追加"):
-            where_logic_op = st.selectbox("論理演算子", ["AND", "OR"], key="where_logic_op", disabled=(len(st.session_state.adhoc_where_conditions_list) == 0))
-            
-            # カラム選択（テーブル名付き）
-            column_options = [""] + [f"{col['qualified_name']} ({col['type']})" for col in all_columns]
-            selected_where_col = st.selectbox("カラムを選択", column_options, key="where_col_name")
-            where_operator = st.selectbox("演算子を選択", ["=", ">", "<", ">=", "<=", "<>", "LIKE", "IN", "IS NULL", "IS NOT NULL"], key="where_operator")
-            
-            # 値の入力（演算子によって表示を変える）
-            if where_operator in ["IS NULL", "IS NOT NULL"]:
-                where_value = ""
-                st.info(f"演算子 '{where_operator}' では値の入力は不要です")
-            elif where_operator == "IN":
-                where_value = st.text_input("値を入力（カンマ区切り）", key="where_value", placeholder="例: 'A','B','C'")
-            elif where_operator == "LIKE":
-                where_value = st.text_input("値を入力", key="where_value", placeholder="例: 東京 (自動で%東京%になります) または %東京 (手動指定)")
-            else:
-                where_value = st.text_input("値を入力", key="where_value")
+            with st.form("add_where_form", clear_on_submit=False):
+                where_logic_op = st.selectbox("論理演算子", ["AND", "OR"], key="where_logic_op", disabled=(len(st.session_state.adhoc_where_conditions_list) == 0))
+                
+                # カラム選択（テーブル名付き）
+                selected_where_col = st.selectbox("カラムを選択", column_options_all, key="where_col_name")
+                where_operator = st.selectbox("演算子を選択", ["=", ">", "<", ">=", "<=", "<>", "LIKE", "IN", "IS NULL", "IS NOT NULL"], key="where_operator")
+                
+                # 値の入力（フォーム内では演算子に応じた切り替えができないため、入力例をまとめて表示）
+                where_value = st.text_input(
+                    "値を入力", key="where_value",
+                    placeholder="例: 東京 / LIKE: 東京 (自動で%東京%) / IN: 'A','B','C'",
+                    help="IS NULL / IS NOT NULL の場合は値の入力は不要です"
+                )
+                
+                submitted_where = st.form_submit_button("追加")
             
-            if st.button("追加", key="add_where_condition_btn") and selected_where_col:
+            if submitted_where and selected_where_col:
                 # カラム名を抽出（テーブル名.カラム名）
                 col_name = selected_where_col.split(" (")[0]  # "(型)" を除去
                 
                 if where_operator in ["IS NULL", "IS NOT NULL"] or where_value:
                     st.session_state.adhoc_where_conditions_list.append({
+                        "id": uuid.uuid4().hex[:8],
                         "logic_op": where_logic_op,
                         "column": col_name,
                         "operator": where_operator,
-                        "value": where_value
+                        "value": "" if where_operator in ["IS NULL", "IS NOT NULL"] else where_value
                     })
                     st.success("WHERE条件を追加しました！")
                     st.rerun()
@@ -1141,6 +1452,7 @@ if st.session_state.selected_table1 and st.session_state.selected_table2:
         st.markdown("#### 📊 GROUP BY集計")
         
         # 既存のGROUP BY条件の表示
+        group_by_lines = []
         for i, condition in enumerate(st.session_state.adhoc_group_by_conditions_list):
             # 新しいデータ構造と古いデータ構造の両方に対応
             if 'group_column' in condition:
@@ -1148,32 +1460,31 @@ if st.session_state.selected_table1 and st.session_state.selected_table2:
                 group_col = condition['group_column']
                 agg_func = condition['aggregate_func']
                 agg_col = condition['aggregate_column']
-                st.write(f"**GROUP BY** `{group_col}` **集計**: {agg_func}(`{agg_col}`)")
+                group_by_lines.append(f"{i + 1}. **GROUP BY** `{group_col}` **集計**: {agg_func}(`{agg_col}`)")
             else:
                 # 古いデータ構造（互換性のため）
                 quoted_col = quote_identifier(condition['column'])
                 if condition.get('aggregate_func'):
-                    st.write(f"**GROUP BY** `{quoted_col}` **集計関数**: {condition['aggregate_func']}")
+                    group_by_lines.append(f"{i + 1}. **GROUP BY** `{quoted_col}` **集計関数**: {condition['aggregate_func']}")
                 else:
-                    st.write(f"**GROUP BY** `{quoted_col}`")
-            
-            if st.button("🗑️", key=f"del_group_by_{i}"):
-                del st.session_state.adhoc_group_by_conditions_list[i]
-                st.rerun()
+                    group_by_lines.append(f"{i + 1}. **GROUP BY** `{quoted_col}`")
+        render_condition_list(group_by_lines, 'adhoc_group_by_conditions_list', "del_group_by")
         
         # GROUP BYカラム追加（グルーピング用）
         st.markdown("##### ➕ グルーピングカラム追加")
         with st.expander("グルーピング対象カラムを追加"):
-            group_column_options = [""] + [f"{col['qualified_name']} ({col['type']})" for col in all_columns]
-            selected_group_col = st.selectbox("GROUP BYカラム", group_column_options, key="add_group_col", 
-                                            help="グルーピングの単位となるカラム（例：性別、年収区分）")
+            with st.form("add_group_col_form"):
+                selected_group_col = st.selectbox("GROUP BYカラム", column_options_all, key="add_group_col", 
+                                                help="グルーピングの単位となるカラム（例：性別、年収区分）")
+                submitted_group_col = st.form_submit_button("追加")
             
-            if st.button("追加", key="add_group_col_btn") and selected_group_col:
+            if submitted_group_col and selected_group_col:
                 # カラム名を抽出
                 group_col_name = selected_group_col.split(" (")[0]
                 
                 # グルーピングカラムとして追加（集計関数なし）
                 st.session_state.adhoc_group_by_conditions_list.append({
+                    "id": uuid.uuid4().hex[:8],
                     "group_column": group_col_name,
                     "aggregate_func": None,
                     "aggregate_column": None,
@@ -1185,55 +1496,45 @@ if st.session_state.selected_table1 and st.session_state.selected_table2:
         # 集計関数追加
         st.markdown("##### ➕ 集計関数追加")
         with st.expander("集計対象を追加"):
-            # 集計関数の選択
+            # 集計関数の選択（対象カラムの候補が変わるため、フォームの外で即時反映する）
             aggregate_functions = ["COUNT", "SUM", "AVG", "MAX", "MIN", "COUNT_DISTINCT"]
             selected_aggregate = st.selectbox("集計関数", aggregate_functions, key="add_aggregate_func",
                                             help="COUNT: 件数、SUM: 合計、AVG: 平均、MAX: 最大、MIN: 最小")
             
-            # 集計対象カラムの選択
-            if selected_aggregate == "COUNT":
-                # COUNTの場合は特別扱い（任意のカラムまたは*）
-                count_options = ["*（全行数）"] + [f"{col['qualified_name']} ({col['type']})" for col in all_columns]
-                selected_agg_col = st.selectbox("COUNT対象", count_options, key="add_count_target_col")
-                if selected_agg_col == "*（全行数）":
-                    agg_col_name = "*"
-                else:
-                    agg_col_name = selected_agg_col.split(" (")[0]
-            elif selected_aggregate == "COUNT_DISTINCT":
-                # COUNT DISTINCTの場合
-                agg_column_options = [""] + [f"{col['qualified_name']} ({col['type']})" for col in all_columns]
-                selected_agg_col = st.selectbox("COUNT DISTINCT対象カラム", agg_column_options, key="add_count_distinct_col")
-                if selected_agg_col:
-                    agg_col_name = selected_agg_col.split(" (")[0]
-                else:
-                    agg_col_name = ""
-            else:
-                # SUM、AVG、MAX、MINの場合は数値型カラムのみ
-                numeric_columns = [col for col in all_columns if is_numeric_type(col['type'])]
-                if numeric_columns:
-                    numeric_options = [""] + [f"{col['qualified_name']} ({col['type']})" for col in numeric_columns]
-                    selected_agg_col = st.selectbox(f"{selected_aggregate}対象カラム（数値型）", numeric_options, key="add_numeric_agg_col")
+            with st.form("add_aggregate_form"):
+                # 集計対象カラムの選択
+                if selected_aggregate == "COUNT":
+                    # COUNTの場合は特別扱い（任意のカラムまたは*）
+                    count_options = ["*（全行数）"] + column_option_labels
+                    selected_agg_col = st.selectbox("COUNT対象", count_options, key="add_count_target_col")
+                    if selected_agg_col == "*（全行数）":
+                        agg_col_name = "*"
+                    else:
+                        agg_col_name = selected_agg_col.split(" (")[0]
+                elif selected_aggregate == "COUNT_DISTINCT":
+                    # COUNT DISTINCTの場合
+                    selected_agg_col = st.selectbox("COUNT DISTINCT対象カラム", column_options_all, key="add_count_distinct_col")
                     if selected_agg_col:
                         agg_col_name = selected_agg_col.split(" (")[0]
                     else:
                         agg_col_name = ""
                 else:
-                    st.warning("数値型カラムがありません。COUNTまたはCOUNT_DISTINCTを選択してください。")
-                    agg_col_name = ""
-            
-            # プレビュー表示
-            if agg_col_name:
-                if selected_aggregate == "COUNT_DISTINCT":
-                    alias_name = f"count_distinct_{agg_col_name.replace('.', '_')}"
-                    preview_text = f"{selected_aggregate}({quote_identifier(agg_col_name)}) AS {quote_identifier(alias_name)}"
-                else:
-                    alias_name = f"{selected_aggregate.lower()}_{agg_col_name.replace('.', '_').replace('*', 'all')}"
-                    agg_col_display = agg_col_name if agg_col_name == "*" else quote_identifier(agg_col_name)
-                    preview_text = f"{selected_aggregate}({agg_col_display}) AS {quote_identifier(alias_name)}"
-                st.code(preview_text, language="sql")
+                    # SUM、AVG、MAX、MINの場合は数値型カラムのみ
+                    if len(numeric_column_options) > 1:
+                        selected_agg_col = st.selectbox(f"{selected_aggregate}対象カラム（数値型）", numeric_column_options, key="add_numeric_agg_col")
+                        if selected_agg_col:
+                            agg_col_name = selected_agg_col.split(" (")[0]
+                        else:
+                            agg_col_name = ""
+                    else:
+                        st.warning("数値型カラムがありません。COUNTまたはCOUNT_DISTINCTを選択してください。")
+                        agg_col_name = ""
+                
+                submitted_aggregate = st.form_submit_button("追加")
             
-            if st.button("追加", key="add_aggregate_btn") and agg_col_name:
+            if submitted_aggregate and agg_col_name:
                 st.session_state.adhoc_group_by_conditions_list.append({
+                    "id": uuid.uuid4().hex[:8],
                     "group_column": None,
                     "aggregate_func": selected_aggregate,
                     "aggregate_column": agg_col_name,
@@ -1248,82 +1549,70 @@ if st.session_state.selected_table1 and st.session_state.selected_table2:
         st.markdown("#### 📈 ORDER BY（ソート条件）")
         
         # 既存のソート条件の表示
+        order_by_lines = []
         for i, condition in enumerate(st.session_state.adhoc_order_by_conditions_list):
             quoted_col = quote_identifier(condition['column'])
             sort_type = condition.get('sort_type', '通常カラム')
             sort_type_icon = "🧮" if sort_type == "集計結果" else "📋"
-            st.write(f"**ORDER BY** {sort_type_icon} `{quoted_col}` **{condition['direction']}** ({sort_type})")
-            if st.button("🗑️", key=f"del_order_by_{i}"):
-                del st.session_state.adhoc_order_by_conditions_list[i]
-                st.rerun()
+            order_by_lines.append(f"{i + 1}. **ORDER BY** {sort_type_icon} `{quoted_col}` **{condition['direction']}** ({sort_type})")
+        render_condition_list(order_by_lines, 'adhoc_order_by_conditions_list', "del_order_by")
 
         # 新しいソート条件の追加フォーム
         with st.expander("➕ ORDER BY条件を追加"):
-            # 基本カラムオプション
-            sort_column_options = [""] + [f"{col['qualified_name']} ({col['type']})" for col in all_columns]
-            
-            # GROUP BYがある場合は集計関数のエイリアス名も追加
-            if st.session_state.adhoc_group_by_conditions_list:
-                st.markdown("**通常カラム**")
-                selected_sort_col = st.selectbox("グルーピングカラムを選択", sort_column_options, key="sort_col_name")
-                
-                # 集計関数のエイリアス名オプション
-                aggregate_options = [""]
-                for condition in st.session_state.adhoc_group_by_conditions_list:
-                    if condition.get('aggregate_func'):
-                        agg_func = condition['aggregate_func']
-                        agg_col = condition['aggregate_column']
-                        
-                        if agg_func == "COUNT_DISTINCT":
-                            alias_name = f"count_distinct_{agg_col.replace('.', '_')}"
-                        else:
-                            alias_suffix = agg_col.replace('.', '_').replace('*', 'all')
-                            alias_name = f"{agg_func.lower()}_{alias_suffix}"
+            with st.form("add_order_by_form"):
+                # GROUP BYがある場合は集計関数のエイリアス名も追加
+                selected_aggregate_sort = ""
+                aggregate_label_to_alias = {}
+                if st.session_state.adhoc_group_by_conditions_list:
+                    st.markdown("**通常カラム**")
+                    selected_sort_col = st.selectbox("グルーピングカラムを選択", column_options_all, key="sort_col_name")
+                    
+                    # 集計関数のエイリアス名オプション（集計関数がある場合のみ作成し、同じ集計の重複は除く）
+                    aggregate_conditions = [
+                        condition for condition in st.session_state.adhoc_group_by_conditions_list
+                        if condition.get('aggregate_func')
+                    ]
+                    if aggregate_conditions:
+                        for condition in aggregate_conditions:
+                            agg_func = condition['aggregate_func']
+                            agg_col = condition['aggregate_column']
+                            
+                            if agg_func == "COUNT_DISTINCT":
+                                alias_name = f"count_distinct_{agg_col.replace('.', '_')}"
+                            else:
+                                alias_suffix = agg_col.replace('.', '_').replace('*', 'all')
+                                alias_name = f"{agg_func.lower()}_{alias_suffix}"
+                            
+                            # 表示ラベル→エイリアス名（dictのため同じ集計の重複も除かれる）
+                            aggregate_label_to_alias[f"🧮 {alias_name} ({agg_func})"] = alias_name
+                        aggregate_options = [""] + list(aggregate_label_to_alias)
                         
-                        aggregate_options.append(f"🧮 {alias_name} ({agg_func})")
-                
-                if len(aggregate_options) > 1:
-                    st.markdown("**集計結果**")
-                    selected_aggregate_sort = st.selectbox("集計結果でソート", aggregate_options, key="sort_aggregate_col",
-                                                         help="例: sum_利用明細_利用金額 で利用金額の多い順にソート")
+                        st.markdown("**集計結果**")
+                        selected_aggregate_sort = st.selectbox("集計結果でソート", aggregate_options, key="sort_aggregate_col",
+                                                             help="例: sum_利用明細_利用金額 で利用金額の多い順にソート（通常カラムより優先）")
                 else:
-                    selected_aggregate_sort = ""
+                    # GROUP BYがない場合は通常の選択
+                    selected_sort_col = st.selectbox("ソート対象カラムを選択", column_options_all, key="sort_col_name")
                 
-                # どちらが選択されているかを判定
-                if selected_aggregate_sort and selected_aggregate_sort != "":
-                    # 集計関数のエイリアス名を抽出
-                    alias_name = selected_aggregate_sort.split(" ")[1]  # "🧮 alias_name (func)" から alias_name を取得
-                    final_sort_col = alias_name
-                    sort_type = "集計結果"
-                elif selected_sort_col and selected_sort_col != "":
-                    # 通常カラム
-                    final_sort_col = selected_sort_col.split(" (")[0]
-                    sort_type = "通常カラム"
-                else:
-                    final_sort_col = ""
-                    sort_type = ""
-            else:
-                # GROUP BYがない場合は通常の選択
-                selected_sort_col = st.selectbox("ソート対象カラムを選択", sort_column_options, key="sort_col_name")
-                if selected_sort_col:
-                    final_sort_col = selected_sort_col.split(" (")[0]
-                    sort_type = "通常カラム"
-                else:
-                    final_sort_col = ""
-                    sort_type = ""
-            
-            sort_direction = st.selectbox("ソート方向を選択", ["ASC", "DESC"], key="sort_direction", help="ASC: 昇順（小→大）、DESC: 降順（大→小）")
+                sort_direction = st.selectbox("ソート方向を選択", ["ASC", "DESC"], key="sort_direction", help="ASC: 昇順（小→大）、DESC: 降順（大→小）")
+                
+                submitted_order_by = st.form_submit_button("追加")
             
-            # プレビュー表示
-            if final_sort_col:
-                if sort_type == "集計結果":
-                    preview_text = f"ORDER BY {quote_identifier(final_sort_col)} {sort_direction}  -- 集計結果でソート"
-                else:
-                    preview_text = f"ORDER BY {final_sort_col} {sort_direction}  -- 通常カラムでソート"
-                st.code(preview_text, language="sql")
+            # どちらが選択されているかを判定（集計結果を優先）
+            if selected_aggregate_sort:
+                final_sort_col = aggregate_label_to_alias[selected_aggregate_sort]
+                sort_type = "集計結果"
+            elif selected_sort_col:
+                # 通常カラム
+                final_sort_col = selected_sort_col.split(" (")[0]
+                sort_type = "通常カラム"
+            else:
+                final_sort_col = ""
+                sort_type = ""
             
-            if st.button("追加", key="add_order_by_btn") and final_sort_col:
+            if submitted_order_by and final_sort_col:
                 st.session_state.adhoc_order_by_conditions_list.append({
+                    "id": uuid.uuid4().hex[:8],
                     "column": final_sort_col,
                     "direction": sort_direction,
                     "sort_type": sort_type  # ソートタイプを記録
@@ -1348,543 +1637,94 @@ else:
 st.markdown("---")
 st.markdown("### 📝 STEP 5: SQLプレビュー・実行")
 
-# 2テーブル結合モード
-if not st.session_state.enable_3table_join and st.session_state.selected_table1 and st.session_state.selected_table2 and st.session_state.join_key1 and st.session_state.join_key2:
-    
-    # 2テーブルSQL生成（スキーマ名を含める）
-    table1_schema = get_table_schema(st.session_state.selected_table1)
-    table2_schema = get_table_schema(st.session_state.selected_table2)
-    quoted_table1 = f"{table1_schema}.{quote_identifier(st.session_state.selected_table1)}"
-    quoted_table2 = f"{table2_schema}.{quote_identifier(st.session_state.selected_table2)}"
-    quoted_key1 = quote_identifier(st.session_state.join_key1)
-    quoted_key2 = quote_identifier(st.session_state.join_key2)
-    
-    # 重複カラム名を検出（選択されたカラムのみを対象）
-    cols1 = get_table_columns(st.session_state.selected_table1)
-    cols2 = get_table_columns(st.session_state.selected_table2)
-    
-    if st.session_state.adhoc_selected_columns:
-        # 選択されたカラムから実際に使用されているカラム名を抽出
-        selected_col_names_t1 = set()
-        selected_col_names_t2 = set()
-        
-        for selected_col in st.session_state.adhoc_selected_columns:
-            # "t1.\"カラム名\"" または "t2.\"カラム名\" AS alias" の形式から元のカラム名を抽出
-            if selected_col.startswith('t1.'):
-                # t1.\"カラム名\" から カラム名 を抽出
-                col_part = selected_col[3:]  # "t1." を除去
-                if ' AS ' in col_part:
-                    col_part = col_part.split(' AS ')[0]  # AS句があれば除去
-                col_name = col_part.strip('"')  # クォートを除去
-                selected_col_names_t1.add(col_name)
-            elif selected_col.startswith('t2.'):
-                # t2.\"カラム名\" から カラム名 を抽出
-                col_part = selected_col[3:]  # "t2." を除去
-                if ' AS ' in col_part:
-                    col_part = col_part.split(' AS ')[0]  # AS句があれば除去
-                col_name = col_part.strip('"')  # クォートを除去
-                selected_col_names_t2.add(col_name)
-        
-        # 選択されたカラム間での重複をチェック
-        duplicate_cols = selected_col_names_t1 & selected_col_names_t2
-    else:
-        # カラム未選択の場合は全カラムで重複チェック（従来通り）
-        table1_col_names = {c['name'] for c in cols1}
-        table2_col_names = {c['name'] for c in cols2}
-        duplicate_cols = table1_col_names & table2_col_names
-    
-    # SELECT句を構築（選択されたカラムのみ）
-    if st.session_state.adhoc_selected_columns:
-        select_clause = "SELECT " + ",\n       ".join(sorted(st.session_state.adhoc_selected_columns))
-    else:
-        # カラム未選択の場合は全カラム（従来通り）
-        select_parts = []
-        
-        # テーブル1のカラム
-        for col in cols1:
-            quoted_col = quote_identifier(col['name'])
-            if col['name'] in duplicate_cols:
-                alias_name = f"t1_{col['name']}"
-                select_parts.append(f"t1.{quoted_col} AS {quote_identifier(alias_name)}")
-            else:
-                select_parts.append(f"t1.{quoted_col}")
-        
-        # テーブル2のカラム
-        for col in cols2:
-            quoted_col = quote_identifier(col['name'])
-            if col['name'] in duplicate_cols:
-                alias_name = f"t2_{col['name']}"
-                select_parts.append(f"t2.{quoted_col} AS {quote_identifier(alias_name)}")
-            else:
-                select_parts.append(f"t2.{quoted_col}")
-        
-        select_clause = "SELECT " + ",\n       ".join(select_parts)
-    
-    # FROM句とJOIN句（2テーブル）
-    join_query = f"""{select_clause}
-FROM {quoted_table1} t1
-{st.session_state.join_type1} {quoted_table2} t2 
-ON t1.{quoted_key1} = t2.{quoted_key2}"""
-    
-    # WHERE句の追加
-    if st.session_state.adhoc_where_conditions_list:
-        where_clauses = []
-        for i, condition in enumerate(st.session_state.adhoc_where_conditions_list):
-            # テーブル名.カラム名の形式でエイリアスを考慮
-            col_with_alias = condition['column']  # 例: "テーブル1.カラム名"
-            if '.' in col_with_alias:
-                table_name, col_name = col_with_alias.split('.', 1)
-                # テーブル名をエイリアスに変換
-                if table_name == st.session_state.selected_table1:
-                    alias_col = f"t1.{quote_identifier(col_name)}"
-                elif table_name == st.session_state.selected_table2:
-                    alias_col = f"t2.{quote_identifier(col_name)}"
-                else:
-                    alias_col = quote_identifier(col_with_alias)
-            else:
-                alias_col = quote_identifier(col_with_alias)
-            
-            if condition['operator'] in ["IS NULL", "IS NOT NULL"]:
-                cond_str = f"{alias_col} {condition['operator']}"
-            elif condition['operator'] == "LIKE":
-                # ユーザーが手動で%を指定している場合はそのまま使用、そうでなければ自動で%を付与
-                like_value = condition['value']
-                if not like_value.startswith('%') and not like_value.endswith('%'):
-                    like_value = f"%{like_value}%"
-                cond_str = f"{alias_col} LIKE '{like_value}'"
-            elif condition['operator'] == "IN":
-                cond_str = f"{alias_col} IN ({condition['value']})"
-            else:
-                cond_str = f"{alias_col} {condition['operator']} '{condition['value']}'"
-            
-            if i == 0:
-                where_clauses.append(cond_str)
-            else:
-                where_clauses.append(f"{condition['logic_op']} {cond_str}")
-        
-        join_query += f"\nWHERE {' '.join(where_clauses)}"
-    
-    # GROUP BY句の追加
-    if st.session_state.adhoc_group_by_conditions_list:
-        group_by_columns = []
-        aggregate_columns = []
-        
-        for condition in st.session_state.adhoc_group_by_conditions_list:
-            # 新しいデータ構造と古いデータ構造の両方に対応
-            if 'group_column' in condition:
-                # 新しいデータ構造
-                if condition.get('is_grouping_column', False):
-                    # グルーピングカラムの場合
-                    group_col_with_alias = condition['group_column']
-                    
-                    # GROUP BYカラムのエイリアス処理
-                    if '.' in group_col_with_alias:
-                        table_name, col_name = group_col_with_alias.split('.', 1)
-                        if table_name == st.session_state.selected_table1:
-                            group_alias_col = f"t1.{quote_identifier(col_name)}"
-                        elif table_name == st.session_state.selected_table2:
-                            group_alias_col = f"t2.{quote_identifier(col_name)}"
-                        else:
-                            group_alias_col = quote_identifier(group_col_with_alias)
-                    else:
-                        group_alias_col = quote_identifier(group_col_with_alias)
-                    
-                    group_by_columns.append(group_alias_col)
-                
-                elif condition.get('aggregate_func'):
-                    # 集計関数の場合
-                    agg_func = condition['aggregate_func']
-                    agg_col_with_alias = condition['aggregate_column']
-                    
-                    # 集計カラムのエイリアス処理
-                    if agg_col_with_alias == "*":
-                        agg_alias_col = "*"
-                    elif '.' in agg_col_with_alias:
-                        table_name, col_name = agg_col_with_alias.split('.', 1)
-                        if table_name == st.session_state.selected_table1:
-                            agg_alias_col = f"t1.{quote_identifier(col_name)}"
-                        elif table_name == st.session_state.selected_table2:
-                            agg_alias_col = f"t2.{quote_identifier(col_name)}"
-                        else:
-                            agg_alias_col = quote_identifier(agg_col_with_alias)
-                    else:
-                        agg_alias_col = quote_identifier(agg_col_with_alias)
-                    
-                    # 集計関数を適用
-                    if agg_func == "COUNT_DISTINCT":
-                        alias_name = f"count_distinct_{agg_col_with_alias.replace('.', '_')}"
-                        agg_expression = f"COUNT(DISTINCT {agg_alias_col}) AS {quote_identifier(alias_name)}"
-                    else:
-                        alias_suffix = agg_col_with_alias.replace('.', '_').replace('*', 'all')
-                        alias_name = f"{agg_func.lower()}_{alias_suffix}"
-                        agg_expression = f"{agg_func}({agg_alias_col}) AS {quote_identifier(alias_name)}"
-                    
-                    aggregate_columns.append(agg_expression)
-            else:
-                # 古いデータ構造（互換性のため）
-                col_with_alias = condition['column']
-                if '.' in col_with_alias:
-                    table_name, col_name = col_with_alias.split('.', 1)
-                    if table_name == st.session_state.selected_table1:
-                        alias_col = f"t1.{quote_identifier(col_name)}"
-                    elif table_name == st.session_state.selected_table2:
-                        alias_col = f"t2.{quote_identifier(col_name)}"
-                    else:
-                        alias_col = quote_identifier(col_with_alias)
-                else:
-                    alias_col = quote_identifier(col_with_alias)
-                group_by_columns.append(alias_col)
-        
-        # GROUP BYとSELECT句の修正
-        if group_by_columns or aggregate_columns:
-            # GROUP BY句がある場合、SELECT句を再構成
-            select_clause = f"SELECT {', '.join(group_by_columns + aggregate_columns)}"
-            # 元のSELECT句を置き換え（複数行にわたる場合も考慮）
-            lines = join_query.split('\n')
-            # SELECT句が複数行にわたる場合を考慮してFROMまでを置き換え
-            from_index = -1
-            for i, line in enumerate(lines):
-                if line.strip().startswith('FROM'):
-                    from_index = i
-                    break
-            
-            if from_index > 0:
-                # SELECT句部分を置き換え
-                join_query = select_clause + '\n' + '\n'.join(lines[from_index:])
-            else:
-                # FROMが見つからない場合は最初の行のみ置き換え
-                join_query = join_query.replace(lines[0], select_clause)
-        
-        if group_by_columns:
-            join_query += f"\nGROUP BY {', '.join(group_by_columns)}"
+# SQL生成・実行の前提条件（2テーブル／3テーブル）
+can_execute_2table = (not st.session_state.enable_3table_join and st.session_state.selected_table1 and st.session_state.selected_table2 and st.session_state.join_key1 and st.session_state.join_key2)
+can_execute_3table = (st.session_state.enable_3table_join and st.session_state.selected_table1 and st.session_state.selected_table2 and st.session_state.selected_table3 and
+                     st.session_state.join_key1 and st.session_state.join_key2 and st.session_state.join_key3 and st.session_state.join_key2_for_join2)
+
+# 2テーブル／3テーブル共通のSQL生成（結合するテーブルの一覧から組み立てる）
+if can_execute_2table or can_execute_3table:
     
-    # ORDER BY句の追加（GROUP BY対応・集計結果ソート対応）
-    if st.session_state.adhoc_order_by_conditions_list:
-        order_by_clauses = []
-        for condition in st.session_state.adhoc_order_by_conditions_list:
-            col_with_alias = condition['column']
-            sort_type = condition.get('sort_type', '通常カラム')
-            
-            if sort_type == "集計結果":
-                # 集計結果でのソート（エイリアス名を直接使用）
-                order_by_clauses.append(f"{quote_identifier(col_with_alias)} {condition['direction']}")
-            elif st.session_state.adhoc_group_by_conditions_list:
-                # GROUP BYがある場合のグルーピングカラム
-                found_in_select = False
-                
-                # GROUP BYカラムにあるかチェック
-                for group_condition in st.session_state.adhoc_group_by_conditions_list:
-                    if group_condition.get('is_grouping_column', False) and group_condition.get('group_column') == col_with_alias:
-                        # GROUP BYカラムの場合
-                        if '.' in col_with_alias:
-                            table_name, col_name = col_with_alias.split('.', 1)
-                            if table_name == st.session_state.selected_table1:
-                                alias_col = f"t1.{quote_identifier(col_name)}"
-                            elif table_name == st.session_state.selected_table2:
-                                alias_col = f"t2.{quote_identifier(col_name)}"
-                            else:
-                                alias_col = quote_identifier(col_with_alias)
-                        else:
-                            alias_col = quote_identifier(col_with_alias)
-                        order_by_clauses.append(f"{alias_col} {condition['direction']}")
-                        found_in_select = True
-                        break
-                
-                if not found_in_select:
-                    # 集計結果でのソートが利用可能になったため、この警告は不要
-                    # ユーザーには集計結果でのソート機能を案内
-                    st.info(f"💡 '{col_with_alias}' は通常カラムです。集計結果でソートしたい場合は「集計結果でソート」オプションをご利用ください。")
-                    continue
-            else:
-                # GROUP BYがない場合は通常処理
-                if '.' in col_with_alias:
-                    table_name, col_name = col_with_alias.split('.', 1)
-                    # テーブル名をエイリアスに変換
-                    if table_name == st.session_state.selected_table1:
-                        alias_col = f"t1.{quote_identifier(col_name)}"
-                    elif table_name == st.session_state.selected_table2:
-                        alias_col = f"t2.{quote_identifier(col_name)}"
-                    else:
-                        alias_col = quote_identifier(col_with_alias)
-                else:
-                    alias_col = quote_identifier(col_with_alias)
-                order_by_clauses.append(f"{alias_col} {condition['direction']}")
-        
-        if order_by_clauses:
-            join_query += f"\nORDER BY {', '.join(order_by_clauses)}"
+    # 結合するテーブル（エイリアス, テーブル名, カラム情報）。カラム情報はSTEP 3の前に取得済みのものを使い回す
+    join_tables = [
+        ('t1', st.session_state.selected_table1, table1_columns),
+        ('t2', st.session_state.selected_table2, table2_columns),
+    ]
+    if can_execute_3table:
+        join_tables.append(('t3', st.session_state.selected_table3, table3_columns))
+    
+    # 結合条件（結合種別, 左エイリアス, 左キー, 右エイリアス, 右キー）
+    joins = [(st.session_state.join_type1, 't1', st.session_state.join_key1, 't2', st.session_state.join_key2)]
+    if can_execute_3table:
+        # テーブル2側の結合キー（未指定の場合はテーブル1との結合キーを使う）
+        key2_for_join2 = st.session_state.join_key2_for_join2 or st.session_state.join_key2
+        joins.append((st.session_state.join_type2, 't2', key2_for_join2, 't3', st.session_state.join_key3))
+    
+    # 重複カラム名を検出（カラム選択時は選択されたカラムのみ、未選択時は全カラムを対象）
+    # テーブル構成・カラム選択が変わった時だけ作り直す（条件追加などの再実行毎の再計算を避ける）
+    duplicate_cache_key = (
+        get_current_data_schema(),
+        tuple((alias, table_name, column_fingerprint(columns)) for alias, table_name, columns in join_tables),
+        frozenset(st.session_state.adhoc_selected_columns),
+    )
+    if st.session_state.get('_adhoc_duplicate_cache_key') != duplicate_cache_key:
+        if st.session_state.adhoc_selected_columns:
+            picked_names = split_selected_columns(duplicate_cache_key[2])
+            names_by_alias = [(alias, picked_names[alias]) for alias, _, _ in join_tables]
+        else:
+            names_by_alias = [(alias, [c['name'] for c in columns]) for alias, _, columns in join_tables]
+        # カラム名→そのカラムを持つテーブルのエイリアス一覧を1回の走査で作る
+        col_locations = {}
+        for alias, names in names_by_alias:
+            for name in names:
+                col_locations.setdefault(name, []).append(alias)
+        st.session_state._adhoc_duplicate_cols = {
+            name: tuple(aliases) for name, aliases in col_locations.items() if len(aliases) > 1
+        }
+        st.session_state._adhoc_duplicate_cache_key = duplicate_cache_key
+    duplicate_cols = st.session_state._adhoc_duplicate_cols
+    
+    # SQL生成に必要な設定だけをJSONにまとめ、同じ設定の再実行ではキャッシュ済みのSQLを使う
+    # （保存名の入力など、SQLに関係しない操作での再生成を避ける）
+    sql_config = {
+        'tables': [
+            (
+                alias,
+                table_name,
+                f"{get_table_schema(table_name)}.{quote_identifier(table_name)}",
+                [] if st.session_state.adhoc_selected_columns else [c['name'] for c in columns],
+            )
+            for alias, table_name, columns in join_tables
+        ],
+        'joins': joins,
+        'selected_columns': sorted(st.session_state.adhoc_selected_columns),
+        'duplicate_cols': sorted(duplicate_cols),
+        'where': st.session_state.adhoc_where_conditions_list,
+        'group_by': st.session_state.adhoc_group_by_conditions_list,
+        'order_by': st.session_state.adhoc_order_by_conditions_list,
+    }
+    sql_config_json = json.dumps(sql_config, ensure_ascii=False, sort_keys=True)
+    # 前回の再実行と設定が変わっていなければ、キャッシュの照合（引数のハッシュ化・結果の復元）もせず前回のSQLを使う
+    if st.session_state.get('_adhoc_last_sql_config') != sql_config_json:
+        st.session_state._adhoc_last_sql_result = build_join_sql(sql_config_json)
+        st.session_state._adhoc_last_sql_config = sql_config_json
+    join_query, skipped_order_columns = st.session_state._adhoc_last_sql_result
+    
+    # GROUP BYがある場合、グルーピングカラム以外の通常カラムではソートできないため案内する
+    for col_with_alias in skipped_order_columns:
+        st.info(f"💡 '{col_with_alias}' は通常カラムです。集計結果でソートしたい場合は「集計結果でソート」オプションをご利用ください。")
     
     # 重複カラム情報を表示
-    if duplicate_cols:
-        st.warning(f"⚠️ 重複カラム検出: {len(duplicate_cols)}個のカラムが両テーブルに存在します。")
-        with st.expander("🔍 重複カラム詳細", expanded=False):
-            st.write("**重複カラム一覧:**")
-            for dup_col in sorted(duplicate_cols):
-                st.write(f"- `{dup_col}` → `t1_{dup_col}` (テーブル1), `t2_{dup_col}` (テーブル2)")
-
-# 3テーブル結合モード
-elif (st.session_state.enable_3table_join and st.session_state.selected_table1 and st.session_state.selected_table2 and st.session_state.selected_table3 and 
-      st.session_state.join_key1 and st.session_state.join_key2 and st.session_state.join_key3 and st.session_state.join_key2_for_join2):
-    
-    # 3テーブルSQL生成（スキーマ名を含める）
-    table1_schema = get_table_schema(st.session_state.selected_table1)
-    table2_schema = get_table_schema(st.session_state.selected_table2)
-    table3_schema = get_table_schema(st.session_state.selected_table3)
-    quoted_table1 = f"{table1_schema}.{quote_identifier(st.session_state.selected_table1)}"
-    quoted_table2 = f"{table2_schema}.{quote_identifier(st.session_state.selected_table2)}"
-    quoted_table3 = f"{table3_schema}.{quote_identifier(st.session_state.selected_table3)}"
-    quoted_key1 = quote_identifier(st.session_state.join_key1)
-    quoted_key2 = quote_identifier(st.session_state.join_key2)
-    quoted_key3 = quote_identifier(st.session_state.join_key3)
-    
-    # 重複カラム名を検出（3テーブル）
-    cols1 = get_table_columns(st.session_state.selected_table1)
-    cols2 = get_table_columns(st.session_state.selected_table2)
-    cols3 = get_table_columns(st.session_state.selected_table3)
-    
-    table1_col_names = {c['name'] for c in cols1}
-    table2_col_names = {c['name'] for c in cols2}
-    table3_col_names = {c['name'] for c in cols3}
-    
-    # 全体での重複を検出
-    all_cols_combined = table1_col_names | table2_col_names | table3_col_names
-    duplicate_cols = set()
-    
-    for col_name in all_cols_combined:
-        tables_with_col = []
-        if col_name in table1_col_names:
-            tables_with_col.append("t1")
-        if col_name in table2_col_names:
-            tables_with_col.append("t2")
-        if col_name in table3_col_names:
-            tables_with_col.append("t3")
-        
-        if len(tables_with_col) > 1:
-            duplicate_cols.add(col_name)
-    
-    # SELECT句を構築（3テーブル・選択されたカラムのみ）
-    if st.session_state.adhoc_selected_columns:
-        select_clause = "SELECT " + ",\n       ".join(sorted(st.session_state.adhoc_selected_columns))
-    else:
-        # カラム未選択の場合は全カラム（従来通り）
-        select_parts = []
-        
-        # テーブル1のカラム
-        for col in cols1:
-            quoted_col = quote_identifier(col['name'])
-            if col['name'] in duplicate_cols:
-                alias_name = f"t1_{col['name']}"
-                select_parts.append(f"t1.{quoted_col} AS {quote_identifier(alias_name)}")
-            else:
-                select_parts.append(f"t1.{quoted_col}")
-        
-        # テーブル2のカラム
-        for col in cols2:
-            quoted_col = quote_identifier(col['name'])
-            if col['name'] in duplicate_cols:
-                alias_name = f"t2_{col['name']}"
-                select_parts.append(f"t2.{quoted_col} AS {quote_identifier(alias_name)}")
-            else:
-                select_parts.append(f"t2.{quoted_col}")
-        
-        # テーブル3のカラム
-        for col in cols3:
-            quoted_col = quote_identifier(col['name'])
-            if col['name'] in duplicate_cols:
-                alias_name = f"t3_{col['name']}"
-                select_parts.append(f"t3.{quoted_col} AS {quote_identifier(alias_name)}")
-            else:
-                select_parts.append(f"t3.{quoted_col}")
-        
-        select_clause = "SELECT " + ",\n       ".join(select_parts)
-    
-    # FROM句とJOIN句（3テーブル）
-    # テーブル2の結合キー2を取得
-    key2_for_join2 = st.session_state.join_key2_for_join2 if st.session_state.join_key2_for_join2 else st.session_state.join_key2
-    quoted_key2_for_join2 = quote_identifier(key2_for_join2)
-    
-    join_query = f"""{select_clause}
-FROM {quoted_table1} t1
-{st.session_state.join_type1} {quoted_table2} t2 
-ON t1.{quoted_key1} = t2.{quoted_key2}
-{st.session_state.join_type2} {quoted_table3} t3 
-ON t2.{quoted_key2_for_join2} = t3.{quoted_key3}"""
-    
-    # WHERE句の追加（3テーブル）
-    if st.session_state.adhoc_where_conditions_list:
-        where_clauses = []
-        for i, condition in enumerate(st.session_state.adhoc_where_conditions_list):
-            # テーブル名.カラム名の形式でエイリアスを考慮（3テーブル）
-            col_with_alias = condition['column']
-            if '.' in col_with_alias:
-                table_name, col_name = col_with_alias.split('.', 1)
-                # テーブル名をエイリアスに変換
-                if table_name == st.session_state.selected_table1:
-                    alias_col = f"t1.{quote_identifier(col_name)}"
-                elif table_name == st.session_state.selected_table2:
-                    alias_col = f"t2.{quote_identifier(col_name)}"
-                elif table_name == st.session_state.selected_table3:
-                    alias_col = f"t3.{quote_identifier(col_name)}"
-                else:
-                    alias_col = quote_identifier(col_with_alias)
-            else:
-                alias_col = quote_identifier(col_with_alias)
-            
-            if condition['operator'] in ["IS NULL", "IS NOT NULL"]:
-                cond_str = f"{alias_col} {condition['operator']}"
-            elif condition['operator'] == "LIKE":
-                # ユーザーが手動で%を指定している場合はそのまま使用、そうでなければ自動で%を付与
-                like_value = condition['value']
-                if not like_value.startswith('%') and not like_value.endswith('%'):
-                    like_value = f"%{like_value}%"
-                cond_str = f"{alias_col} LIKE '{like_value}'"
-            elif condition['operator'] == "IN":
-                cond_str = f"{alias_col} IN ({condition['value']})"
-            else:
-                cond_str = f"{alias_col} {condition['operator']} '{condition['value']}'"
-            
-            if i == 0:
-                where_clauses.append(cond_str)
-            else:
-                where_clauses.append(f"{condition['logic_op']} {cond_str}")
-        
-        join_query += f"\nWHERE {' '.join(where_clauses)}"
-    
-    # GROUP BY句の追加（3テーブル）
-    if st.session_state.adhoc_group_by_conditions_list:
-        group_by_columns = []
-        aggregate_columns = []
-        
-        for condition in st.session_state.adhoc_group_by_conditions_list:
-            # 新しいデータ構造と古いデータ構造の両方に対応
-            if 'group_column' in condition:
-                # 新しいデータ構造
-                group_col_with_alias = condition['group_column']
-                agg_func = condition['aggregate_func']
-                agg_col_with_alias = condition['aggregate_column']
-                
-                # GROUP BYカラムのエイリアス処理（3テーブル）
-                if '.' in group_col_with_alias:
-                    table_name, col_name = group_col_with_alias.split('.', 1)
-                    if table_name == st.session_state.selected_table1:
-                        group_alias_col = f"t1.{quote_identifier(col_name)}"
-                    elif table_name == st.session_state.selected_table2:
-                        group_alias_col = f"t2.{quote_identifier(col_name)}"
-                    elif table_name == st.session_state.selected_table3:
-                        group_alias_col = f"t3.{quote_identifier(col_name)}"
-                    else:
-                        group_alias_col = quote_identifier(group_col_with_alias)
-                else:
-                    group_alias_col = quote_identifier(group_col_with_alias)
-                
-                group_by_columns.append(group_alias_col)
-                
-                # 集計カラムのエイリアス処理（3テーブル）
-                if agg_col_with_alias == "*":
-                    agg_alias_col = "*"
-                elif '.' in agg_col_with_alias:
-                    table_name, col_name = agg_col_with_alias.split('.', 1)
-                    if table_name == st.session_state.selected_table1:
-                        agg_alias_col = f"t1.{quote_identifier(col_name)}"
-                    elif table_name == st.session_state.selected_table2:
-                        agg_alias_col = f"t2.{quote_identifier(col_name)}"
-                    elif table_name == st.session_state.selected_table3:
-                        agg_alias_col = f"t3.{quote_identifier(col_name)}"
-                    else:
-                        agg_alias_col = quote_identifier(agg_col_with_alias)
-                else:
-                    agg_alias_col = quote_identifier(agg_col_with_alias)
-                
-                # 集計関数を適用
-                if agg_func == "COUNT_DISTINCT":
-                    alias_name = f"count_distinct_{agg_col_with_alias.replace('.', '_')}"
-                    agg_expression = f"COUNT(DISTINCT {agg_alias_col}) AS {quote_identifier(alias_name)}"
-                else:
-                    alias_suffix = agg_col_with_alias.replace('.', '_').replace('*', 'all')
-                    alias_name = f"{agg_func.lower()}_{alias_suffix}"
-                    agg_expression = f"{agg_func}({agg_alias_col}) AS {quote_identifier(alias_name)}"
-                
-                aggregate_columns.append(agg_expression)
-            else:
-                # 古いデータ構造（互換性のため）
-                col_with_alias = condition['column']
-                if '.' in col_with_alias:
-                    table_name, col_name = col_with_alias.split('.', 1)
-                    if table_name == st.session_state.selected_table1:
-                        alias_col = f"t1.{quote_identifier(col_name)}"
-                    elif table_name == st.session_state.selected_table2:
-                        alias_col = f"t2.{quote_identifier(col_name)}"
-                    elif table_name == st.session_state.selected_table3:
-                        alias_col = f"t3.{quote_identifier(col_name)}"
-                    else:
-                        alias_col = quote_identifier(col_with_alias)
-                else:
-                    alias_col = quote_identifier(col_with_alias)
-                group_by_columns.append(alias_col)
-        
-        # GROUP BYとSELECT句の修正（3テーブル）
-        if aggregate_columns:
-            # 集計関数がある場合、SELECT句を再構成
-            select_clause = f"SELECT {', '.join(group_by_columns + aggregate_columns)}"
-            # 元のSELECT句を置き換え（複数行にわたる場合も考慮）
-            lines = join_query.split('\n')
-            # SELECT句が複数行にわたる場合を考慮してFROMまでを置き換え
-            from_index = -1
-            for i, line in enumerate(lines):
-                if line.strip().startswith('FROM'):
-                    from_index = i
-                    break
-            
-            if from_index > 0:
-                # SELECT句部分を置き換え
-                join_query = select_clause + '\n' + '\n'.join(lines[from_index:])
-            else:
-                # FROMが見つからない場合は最初の行のみ置き換え
-                join_query = join_query.replace(lines[0], select_clause)
-        
-        join_query += f"\nGROUP BY {', '.join(group_by_columns)}"
-    
-    # ORDER BY句の追加（3テーブル）
-    if st.session_state.adhoc_order_by_conditions_list:
-        order_by_clauses = []
-        for condition in st.session_state.adhoc_order_by_conditions_list:
-            # テーブル名.カラム名の形式でエイリアスを考慮（3テーブル）
-            col_with_alias = condition['column']
-            if '.' in col_with_alias:
-                table_name, col_name = col_with_alias.split('.', 1)
-                # テーブル名をエイリアスに変換
-                if table_name == st.session_state.selected_table1:
-                    alias_col = f"t1.{quote_identifier(col_name)}"
-                elif table_name == st.session_state.selected_table2:
-                    alias_col = f"t2.{quote_identifier(col_name)}"
-                elif table_name == st.session_state.selected_table3:
-                    alias_col = f"t3.{quote_identifier(col_name)}"
-                else:
-                    alias_col = quote_identifier(col_with_alias)
-            else:
-                alias_col = quote_identifier(col_with_alias)
-            order_by_clauses.append(f"{alias_col} {condition['direction']}")
-        join_query += f"\nORDER BY {', '.join(order_by_clauses)}"
-    
-    # 重複カラム情報を表示（3テーブル）
     if duplicate_cols:
         st.warning(f"⚠️ 重複カラム検出: {len(duplicate_cols)}個のカラムが複数テーブルに存在します。")
         with st.expander("🔍 重複カラム詳細", expanded=False):
-            st.write("**重複カラム一覧:**")
-            for dup_col in sorted(duplicate_cols):
-                tables_info = []
-                if dup_col in table1_col_names:
-                    tables_info.append(f"`t1_{dup_col}` (テーブル1)")
-                if dup_col in table2_col_names:
-                    tables_info.append(f"`t2_{dup_col}` (テーブル2)")
-                if dup_col in table3_col_names:
-                    tables_info.append(f"`t3_{dup_col}` (テーブル3)")
-                st.write(f"- `{dup_col}` → {', '.join(tables_info)}")
+            st.markdown("**重複カラム一覧:**\n\n" + "\n".join(
+                f"- `{dup_col}` → " + ", ".join(f"`{alias}_{dup_col}` (テーブル{alias[1:]})" for alias in duplicate_cols[dup_col])
+                for dup_col in sorted(duplicate_cols)
+            ))
 
 # SQL実行部分（共通）
 # カラム選択必須条件を追加
-can_execute_2table = (not st.session_state.enable_3table_join and st.session_state.selected_table1 and st.session_state.selected_table2 and st.session_state.join_key1 and st.session_state.join_key2)
-can_execute_3table = (st.session_state.enable_3table_join and st.session_state.selected_table1 and st.session_state.selected_table2 and st.session_state.selected_table3 and 
-                     st.session_state.join_key1 and st.session_state.join_key2 and st.session_state.join_key3 and st.session_state.join_key2_for_join2)
 
 if (can_execute_2table or can_execute_3table) and st.session_state.adhoc_selected_columns:
     
@@ -1913,7 +1753,6 @@ if (can_execute_2table or can_execute_3table) and st.session_state.adhoc_selecte
         
         if st.button("💾 保存", key="save_adhoc_object"):
             if object_name:
-                import uuid
                 
                 object_data = {
                     'object_id': f"adhoc_{uuid.uuid4().hex[:12]}",
@@ -2397,6 +2236,29 @@ with tab3:
         
         tasks = get_scheduled_tasks_adhoc()
         if tasks:
+            # 一括操作（ALTER TASKをまとめて1回で送信）
+            col_bulk1, col_bulk2, _ = st.columns([1, 1, 3])
+            with col_bulk1:
+                if st.button("⏸️ すべて一時停止", key="adhoc_bulk_suspend"):
+                    success, msg = bulk_task_action(
+                        [t['name'] for t in tasks if t['state'] == 'started'], "SUSPEND"
+                    )
+                    if success:
+                        st.success(msg)
+                        st.rerun()
+                    else:
+                        st.error(f"エラー: {msg}")
+            with col_bulk2:
+                if st.button("▶️ すべて再開", key="adhoc_bulk_resume"):
+                    success, msg = bulk_task_action(
+                        [t['name'] for t in tasks if t['state'] != 'started'], "RESUME"
+                    )
+                    if success:
+                        st.success(msg)
+                        st.rerun()
+                    else:
+                        st.error(f"エラー: {msg}")
+            
             for task in tasks:
                 with st.expander(f"📋 {task['name']}", expanded=False):
                     col_task1, col_task2 = st.columns([2, 1])